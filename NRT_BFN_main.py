@@ -22,6 +22,11 @@ def main():
     draw_L3 = True # True or False
     make_alongtrack_rmse = True # True or False
     make_duacs_comp = 'interactive' # Available options: 'today', 'YYYY-MM-DD' (choose a date), 'interactive', 'none'
+    prefetch_next_date = False # True or False # Reanalysis backfills: download the inputs of final_date + 1 day during this run
+    profile_run = False # True or False # Time, CPU, peak memory and I/O of each stage, written to maps_<name_experiment>/<date>_report.json/.csv
+    profile_cprofile = False # True or False # Also dump cProfile statistics of each stage (requires profile_run)
+    processing_dtype = 'float64' # 'float64' or 'float32' # Working precision of the boundary conditions and of the post-processing (float32 halves memory and product sizes)
+    pack_products = False # True or False # Deliver the maps as int16 with CF scale_factor/add_offset
 
     dir_massh = '../MASSH/mapping'
     path_config = './NRT_BFN_main_config.py' 
@@ -52,8 +57,14 @@ def main():
     ###  1. DATA DOWNLOAD
     ###########################################################################################################################################
 
+    # Stages of the run are scheduled as soon as the data they need is ready, e.g. the L4 product is filled while L3 tracks are still arriving
+    from tools.pipeline import Pipeline
+    from tools.profiling import RunProfiler
+    profiler = RunProfiler(cprofile=profile_cprofile) if profile_run == True else None
+    pipeline = Pipeline(max_workers=4, profiler=profiler)
+
     from tools.ftp_transfer import download_nadirs_cmems, download_swot_nadir
-    from tools.processing import make_mdt
+    from tools.processing import make_mdt, subset_alongtrack
 
     # What datasets to download
     datasets = [
@@ -67,26 +78,43 @@ def main():
     ]
 
     dataset_l4 = 'dataset-duacs-nrt-global-merged-allsat-phy-l4'
+    cache_dir = currdir+'/input_'+name_experiment+'/cache'
 
-    # FTP connection to CMEMS server and observational data download
-    download_nadirs_cmems(name_experiment, currdir, today, numdays, datasets, dataset_l4)
-    download_swot_nadir(name_experiment, currdir, today)
+    def input_stages(date, prefix='', after=()):
+        # FTP connection to CMEMS server and observational data download
+        # Downloads sharing the observation cache are chained (after), the other stages only wait for the data they need
+        l4 = pipeline.add(prefix+'download_l4', lambda: download_nadirs_cmems(name_experiment, currdir, date, numdays, [], dataset_l4, cache_dir=cache_dir), deps=after)
+        l3 = pipeline.add(prefix+'download_l3', lambda: download_nadirs_cmems(name_experiment, currdir, date, numdays, datasets, None, cache_dir=cache_dir, cache_max_age=60), deps=[l4])
+        swot = pipeline.add(prefix+'download_swot', lambda: download_swot_nadir(name_experiment, currdir, date, numdays), deps=after)
 
-    # If needed, download and properly formats mdt file
-    make_mdt(name_experiment, currdir,bbox)
+        # Cut alongtrack files to the domain (plus a halo) and the assimilation window, so that MASSH only reads what it needs.
+        # The originals are replaced by the subset, as they are kept in the observation cache. SWOT nadir files are not cached
+        # (nor synced incrementally), so they are left as downloaded.
+        def subset():
+            for dataset in datasets:
+                subset_alongtrack(currdir+'/input_'+name_experiment+'/'+date.strftime('%Y%m%d')+'/'+dataset, bbox, window=(date-timedelta(days=numdays+1), date+timedelta(days=1)), remove_originals=True)
+        sub = pipeline.add(prefix+'subset_l3', subset, deps=[l3])
 
-    ############################################################################################################################################
-    ### 2. BOUNDARY CONDITIONS
-    ############################################################################################################################################
+        ########################################################################################################################################
+        ### 2. BOUNDARY CONDITIONS
+        ########################################################################################################################################
+
+        from tools.processing import compute_filled_map
 
-    from tools.processing import compute_filled_map
+        # Rework DUACS dataset for optimal boundary conditions : extrapolate data to fill coasts. 
+        # Then a mask is used in MASSH to select only ocean and avoid awkward 0 values around coasts
+        BC_data_path = currdir+'/input_'+name_experiment+'/'+date.strftime('%Y%m%d')+'/dataset-duacs-nrt-global-merged-allsat-phy-l4/*.nc'
+        save_new_BC_to = currdir+'/input_'+name_experiment+'/'+date.strftime('%Y%m%d')+'/duacs_l4_filled.nc'
 
-    # Rework DUACS dataset for optimal boundary conditions : extrapolate data to fill coasts. 
-    # Then a mask is used in MASSH to select only ocean and avoid awkward 0 values around coasts
-    BC_data_path = currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/dataset-duacs-nrt-global-merged-allsat-phy-l4/*.nc'
-    save_new_BC_to = currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/duacs_l4_filled.nc'
+        # Days already filled by previous runs are reused. The warm start (new days start from the closest known solution)
+        # is left off until it is benchmarked as fast as the cold fill at equal accuracy
+        bc = pipeline.add(prefix+'compute_filled_map', lambda: compute_filled_map(BC_data_path, save_new_BC_to, bbox, warm_start=False, cache_dir=currdir+'/input_'+name_experiment+'/bc_cache', dtype=processing_dtype), deps=[l4])
+        return l3, swot, sub, bc
 
-    compute_filled_map(BC_data_path, save_new_BC_to, bbox)
+    download_l3, download_swot, subset_l3, filled_map = input_stages(today)
+
+    # If needed, download and properly formats mdt file
+    mdt = pipeline.add('make_mdt', lambda: make_mdt(name_experiment, currdir,bbox))
 
     ############################################################################################################################################
     ### 3. DATA ASSIMILATION WITH MASSH (BFN-QG)
@@ -94,11 +122,11 @@ def main():
 
     # State
     from src import state as state
-    State = state.State(config)
+    pipeline.add('state', lambda: state.State(config), deps=[filled_map])
 
     # Obs
     from src import obs as obs
-    dict_obs = obs.Obs(config,State)
+    pipeline.add('obs', lambda: obs.Obs(config,pipeline.results['state']), deps=['state', subset_l3, download_swot, mdt])
 
     if draw_L3 == True:
         from tools.plot_tools import plot_l3_data
@@ -111,26 +139,36 @@ def main():
             'obs*SWOTN',
             'obs*'
         ]
-        plot_l3_data(bbox, l3_datasets, today, numdays, name_experiment)
+        pipeline.add('plot_l3_data', lambda: plot_l3_data(bbox, l3_datasets, today, numdays, name_experiment), deps=['obs'], resources=['pyplot'])
+
+    def inversion():
+        State = pipeline.results['state']
+
+        # Model
+        from src import mod as mod
+        Model = mod.Model(config,State)
+
+        # Bondary Conditions
+        from src import bc as bc
+        Bc = bc.Bc(config)
 
-    # Model
-    from src import mod as mod
-    Model = mod.Model(config,State)
+        # Inversion
+        from src import inv as inv
+        inv.Inv(config,State,Model,dict_obs=pipeline.results['obs'],Bc=Bc)
 
-    # Bondary Conditions
-    from src import bc as bc
-    Bc = bc.Bc(config)
+    # MASSH may plot during the inversion
+    pipeline.add('inversion', inversion, deps=['obs'], resources=['pyplot'])
 
-    # Inversion
-    from src import inv as inv
-    inv.Inv(config,State,Model,dict_obs=dict_obs,Bc=Bc)
+    # Reanalysis backfills : fetch the inputs of the next final_date while this one is assimilated
+    if prefetch_next_date == True:
+        input_stages(today+timedelta(days=1), prefix='next_', after=[download_l3, download_swot])
 
     ###########################################################################################################################################
     ### 4. RESULTS PROCESSING
     ###########################################################################################################################################
 
     from tools.processing import nc_processing
-    nc_processing(name_experiment, today=today, numdays=6)
+    pipeline.add('nc_processing', lambda: nc_processing(name_experiment, today=today, numdays=6, dtype=processing_dtype, pack_int16=pack_products), deps=['inversion'])
 
     ##############################################################################################################################
     ### 5. DIAGNOSTICS
@@ -139,14 +177,14 @@ def main():
     ##### 5.1 DUACS COMPARISON
 
     from tools.plot_tools import plot_duacs_comp
-    plot_duacs_comp(config.EXP.init_date, name_experiment, today, bbox, make_duacs_comp)
+    diagnostics = [pipeline.add('plot_duacs_comp', lambda: plot_duacs_comp(config.EXP.init_date, name_experiment, today, bbox, make_duacs_comp), deps=['nc_processing'], resources=['pyplot'])]
 
     ##### 5.2 ALONGTRACK OBS COMPARISON
 
     if make_alongtrack_rmse == True:
         from tools.plot_tools import plot_alongtrack_rmse, plot_25_random_tracks
-        plot_25_random_tracks('./scratch/'+name_experiment+'/', name_experiment, today.strftime('%Y%m%d'))
-        plot_alongtrack_rmse('./scratch/'+name_experiment+'/', name_experiment, today.strftime('%Y%m%d'))
+        diagnostics.append(pipeline.add('plot_25_random_tracks', lambda: plot_25_random_tracks('./scratch/'+name_experiment+'/', name_experiment, today.strftime('%Y%m%d')), deps=['nc_processing'], resources=['pyplot']))
+        diagnostics.append(pipeline.add('plot_alongtrack_rmse', lambda: plot_alongtrack_rmse('./scratch/'+name_experiment+'/', name_experiment, today.strftime('%Y%m%d')), deps=['nc_processing'], resources=['pyplot']))
 
 
     ##### 5.3 LAMTA LAGRANGIAN DIAGNOSTICS
@@ -154,7 +192,8 @@ def main():
     if make_lagrangian_diags == True:
         dir_lamta = '/bettik/PROJECTS/pr-data-ocean/stellaa/lamtaLR'
         from tools.processing import apply_lamta
-        lamta_diags_results = apply_lamta(name_experiment, currdir, dir_lamta, today, bbox, numdays=30, bathylvl =-1000)
+        # apply_lamta changes the working directory
+        diagnostics.append(pipeline.add('apply_lamta', lambda: apply_lamta(name_experiment, currdir, dir_lamta, today, bbox, numdays=30, bathylvl =-1000), deps=diagnostics, resources=['pyplot']))
 
     ###########################################################################################################################################
     ### 6. MAPS UPLOAD
@@ -162,7 +201,14 @@ def main():
 
     if destination == 'ifremer':
         from tools.ftp_transfer import ftp_to_ifremer
-        ftp_to_ifremer(name_experiment, today, currdir)
+        pipeline.add('upload', lambda: ftp_to_ifremer(name_experiment, today, currdir), deps=diagnostics)
+
+    try:
+        pipeline.run()
+    finally:
+        pipeline.report()
+        if profiler is not None:
+            profiler.write_report(currdir+'/maps_'+name_experiment+'/'+today.strftime('%Y%m%d')+'_report')
 
 
 if __name__ == "__main__":
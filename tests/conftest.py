@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tools package is used from the root of the repository, as in NRT_BFN_main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
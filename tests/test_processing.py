@@ -0,0 +1,31 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+pytest.importorskip('pyinterp')
+from tools.processing import bin_means, time_bins
+
+def outputs_with_gap():
+    # 3-hourly states over 2 days, without any state on 2023-04-12 (00h-24h)
+    times = pd.date_range('2023-04-11 03:00', '2023-04-13 00:00', freq='3h')
+    times = times[(times <= '2023-04-12 00:00') | (times > '2023-04-13 00:00')].append(pd.DatetimeIndex(['2023-04-13 00:00']))
+    ssh = np.random.default_rng(0).standard_normal((len(times), 4, 5))
+    return xr.Dataset({'ssh': (['time', 'lat', 'lon'], ssh)}, coords={'time': times, 'lat': np.arange(4.), 'lon': np.arange(5.)})
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_bin_means_leaves_out_empty_bins(chunked):
+    ds = outputs_with_gap()
+    if chunked:
+        ds = ds.chunk({'time': 3})
+    bin_index, labels = time_bins(ds.time.values, datetime(2023, 4, 13), numdays=2, frequency_hours=6)
+    binned = bin_means(ds, bin_index, labels).compute()
+
+    assert len(labels) == 8
+    assert binned.sizes['time'] == 5
+    assert not binned.ssh.isnull().all(dim=['lat', 'lon']).any()
+    for i, label in enumerate(binned.time.values):
+        expected = ds.ssh.values[bin_index == list(labels).index(label)].mean(axis=0)
+        np.testing.assert_allclose(binned.ssh.values[i], expected)
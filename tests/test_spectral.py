@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from tools.grid import GridMetrics
+from tools.spectral import spectral_uvrv
+from tools.vars import h2uvrv
+
+def smooth_field():
+    lon = np.arange(-145, -135, 1/16)
+    lat = np.arange(25, 35, 1/16)
+    x, y = np.meshgrid(np.radians(lon), np.radians(lat))
+    ssh = np.stack([0.3*np.sin(18*x+k)*np.cos(24*y) for k in range(2)])
+    return ssh, GridMetrics(lon, lat)
+
+def test_spectral_matches_finite_differences():
+    ssh, metrics = smooth_field()
+    for spectral, finite_difference in zip(spectral_uvrv(ssh, metrics), h2uvrv(ssh, metrics = metrics, backend = 'numpy')):
+        assert np.abs(spectral-finite_difference).max() < 1e-3*np.abs(finite_difference).max()
+
+def test_spectral_rejects_masked_field():
+    ssh, metrics = smooth_field()
+    ssh[:, 40:70, 50:90] = np.nan
+    with pytest.raises(ValueError):
+        spectral_uvrv(ssh, metrics)
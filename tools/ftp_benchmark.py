@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description: Offline benchmark of the download functions of tools.ftp_transfer. A local FTP server mirroring the
+layout of the CMEMS and AVISO servers is filled with synthetic NetCDF files, then download_nadirs_cmems and
+download_swot_nadir are timed against it, with optional injected latency and connexion failures.
+
+Requires pyftpdlib, an optional dependency of environment.yml and requirements.txt (pip install pyftpdlib).
+
+Usage: python -m tools.ftp_benchmark --connections 1 4 8 --latency 0.05 --failure-rate 0.02
+"""
+
+import os
+import io
+import sys
+import time
+import random
+import logging
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import numpy as np
+import xarray as xr
+from pandas import date_range
+from datetime import datetime, timedelta
+
+L3_PRODUCT = '/Core/SEALEVEL_GLO_PHY_L3_NRT_OBSERVATIONS_008_044/'
+L4_PRODUCT = '/Core/SEALEVEL_GLO_PHY_L4_NRT_OBSERVATIONS_008_046/'
+SWOT_PATH = '/swot_beta_products/l3_karin_nadir/'
+
+DATASETS = [
+    'dataset-duacs-nrt-global-al-phy-l3',
+    'dataset-duacs-nrt-global-c2n-phy-l3',
+    'dataset-duacs-nrt-global-h2b-phy-l3',
+    'dataset-duacs-nrt-global-s3a-phy-l3',
+    'dataset-duacs-nrt-global-s3b-phy-l3',
+    'cmems_obs-sl_glo_phy-ssh_nrt_j3n-l3-duacs_PT1S',
+    'cmems_obs-sl_glo_phy-ssh_nrt_s6a-hr-l3-duacs_PT1S',
+]
+
+DATASET_L4 = 'dataset-duacs-nrt-global-merged-allsat-phy-l4'
+
+def synthetic_track(day, points):
+
+    """
+    Creates one day of a synthetic alongtrack (L3) product.
+
+    Args:
+        day (datetime.datetime): Day of the track.
+        points (int): Number of observations.
+
+    Returns:
+        xarray.Dataset: Track with 'sla_unfiltered', 'longitude' and 'latitude' along 'time'.
+    """
+
+    time = date_range(day, periods=points, freq=timedelta(seconds=86400/points))
+    phase = np.linspace(0, 14*2*np.pi, points)
+    return xr.Dataset(
+        data_vars=dict(
+            sla_unfiltered=('time', 0.1*np.random.randn(points).astype('float32')),
+            longitude=('time', (np.degrees(phase)/14*25) % 360),
+            latitude=('time', 66*np.sin(phase)),
+        ),
+        coords=dict(time=time),
+    )
+
+def synthetic_map(day, resolution):
+
+    """
+    Creates one day of a synthetic gridded (L4) product.
+
+    Args:
+        day (datetime.datetime): Day of the map.
+        resolution (float): Grid step in degrees.
+
+    Returns:
+        xarray.Dataset: Map with 'adt' on (time, latitude, longitude).
+    """
+
+    lon = np.arange(-180, 180, resolution)
+    lat = np.arange(-80, 80+resolution, resolution)
+    adt = np.sin(np.radians(lat))[:, None]*np.cos(np.radians(lon))[None, :]
+    return xr.Dataset(
+        data_vars=dict(adt=(['time', 'latitude', 'longitude'], adt[None].astype('float32'))),
+        coords=dict(time=[np.datetime64(day)], latitude=lat, longitude=lon),
+    )
+
+def make_synthetic_archive(root, today, numdays, points = 20000, resolution = 1., swot_versions = 2):
+
+    """
+    Fills a folder with synthetic products, organised as on the CMEMS and AVISO FTP servers.
+
+    Args:
+        root (str): Root folder of the fake server.
+        today (datetime.datetime): Last day of data.
+        numdays (int): Number of days of data before today. Whole month folders are filled, as on the real servers.
+        points (int, optional): Number of observations per L3 file. Default is 20000.
+        resolution (float, optional): Grid step of the L4 maps in degrees. Default is 1.
+        swot_versions (int, optional): Number of uploads of each SWOT nadir data date. Default is 2.
+
+    Returns:
+        None
+    """
+
+    first_day = today - timedelta(days=numdays)
+    days = date_range(datetime(first_day.year, first_day.month, 1), today, freq='D')
+
+    for day in days:
+        production = (day + timedelta(days=2)).strftime('%Y%m%d')
+        track = synthetic_track(day, points)
+        for dataset in DATASETS:
+            folder = root+L3_PRODUCT+dataset+day.strftime('/%Y/%m/')
+            os.makedirs(folder, exist_ok=True)
+            sat = dataset.split('-')[4] if dataset.startswith('dataset') else dataset.split('_')[5].split('-')[0]
+            track.to_netcdf(folder+'nrt_global_'+sat+'_phy_l3_'+day.strftime('%Y%m%d')+'_'+production+'.nc')
+
+        folder = root+L4_PRODUCT+DATASET_L4+day.strftime('/%Y/%m/')
+        os.makedirs(folder, exist_ok=True)
+        synthetic_map(day, resolution).to_netcdf(folder+'nrt_global_allsat_phy_l4_'+day.strftime('%Y%m%d')+'_'+production+'.nc')
+
+        os.makedirs(root+SWOT_PATH, exist_ok=True)
+        for version in range(swot_versions):
+            upload = (day + timedelta(days=1+version)).strftime('%Y%m%d')
+            track.to_netcdf(root+SWOT_PATH+'nrt_global_swonc_phy_l3_1hz_'+day.strftime('%Y%m%d')+'_'+upload+'.nc')
+
+def start_server(root, latency = 0., failure_rate = 0., username = 'bench', password = 'bench'):
+
+    """
+    Starts a local FTP server on a free port, in a background thread.
+
+    Args:
+        root (str): Folder served as the root of the FTP server.
+        latency (float, optional): Delay in seconds added to every FTP command, to mimic a remote server. Default is 0.
+        failure_rate (float, optional): Probability that a RETR command drops the control connexion. Default is 0.
+        username (str, optional): FTP login. Default is 'bench'.
+        password (str, optional): FTP password. Default is 'bench'.
+
+    Returns:
+        tuple: (server, address) with address as 'host:port'. Call server.close_all() to stop it.
+    """
+
+    try:
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+        from pyftpdlib.log import config_logging
+    except ImportError:
+        sys.exit('The FTP benchmark requires pyftpdlib: pip install pyftpdlib')
+
+    class SlowFlakyHandler(FTPHandler):
+
+        def pre_process_command(self, line, cmd, arg):
+            # One thread per connexion: sleeping only delays this client
+            if latency:
+                time.sleep(latency)
+            super().pre_process_command(line, cmd, arg)
+
+        def ftp_RETR(self, file):
+            if random.random() < failure_rate:
+                self.respond('421 Injected failure, closing control connection.')
+                self.close_when_done()
+                return
+            return super().ftp_RETR(file)
+
+    config_logging(level=logging.WARNING)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(username, password, root, perm='elradfmwMT')
+    SlowFlakyHandler.authorizer = authorizer
+
+    server = ThreadedFTPServer(('127.0.0.1', 0), SlowFlakyHandler)
+    threading.Thread(target=server.serve_forever, kwargs=dict(handle_exit=False), daemon=True).start()
+    return server, '127.0.0.1:'+str(server.address[1])
+
+def folder_stats(path):
+
+    """ Returns the number of complete files and their total size (bytes) in a folder tree. """
+
+    nfiles, nbytes = 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if not filename.endswith('.part'):
+                nfiles += 1
+                nbytes += os.path.getsize(os.path.join(dirpath, filename))
+    return nfiles, nbytes
+
+def run_benchmark(address, today, numdays, n_connections = 4, sync = False, verbose = False, username = 'bench', password = 'bench'):
+
+    """
+    Times download_nadirs_cmems and download_swot_nadir against a (local) FTP server.
+
+    Args:
+        address (str): Address of the server ('host:port').
+        today (datetime.datetime): Experiment date.
+        numdays (int): Number of days of the assimilation window.
+        n_connections (int, optional): Number of FTP connexions of download_nadirs_cmems. Default is 4.
+        sync (bool, optional): Use the incremental sync mode of download_nadirs_cmems. Default is False.
+        verbose (bool, optional): Show the messages of the download functions. Default is False.
+        username (str, optional): FTP login. Default is 'bench'.
+        password (str, optional): FTP password. Default is 'bench'.
+
+    Returns:
+        list: One dict per function with the wall time (s), number of files, MB, files/s and MB/s.
+    """
+
+    import tools.ftp_transfer as ftp_transfer
+
+    workdir = tempfile.mkdtemp(prefix='nrt_bfn_bench_')
+    name_experiment = 'benchmark'
+    input_dir = workdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'
+
+    runs = [
+        ('download_nadirs_cmems', lambda: ftp_transfer.download_nadirs_cmems(name_experiment, workdir, today, numdays, DATASETS, DATASET_L4,
+                                                                             n_connections=n_connections, retries=10, host=address, sync=sync)),
+        ('download_swot_nadir', lambda: ftp_transfer.download_swot_nadir(name_experiment, workdir, today, numdays, retries=10, host=address)),
+    ]
+
+    # The download functions read their credentials from the module, the real ones are put back at the end
+    credentials = ('cmems_username', 'cmems_password', 'swot_username', 'swot_password')
+    saved = {key: getattr(ftp_transfer.secretcodes, key) for key in credentials}
+    ftp_transfer.secretcodes.cmems_username = ftp_transfer.secretcodes.swot_username = username
+    ftp_transfer.secretcodes.cmems_password = ftp_transfer.secretcodes.swot_password = password
+
+    results = []
+    try:
+        for name, run in runs:
+            before = folder_stats(input_dir)
+            out = sys.stdout if verbose else io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(out):
+                run()
+            wall = time.perf_counter() - start
+            after = folder_stats(input_dir)
+            nfiles, mbytes = after[0]-before[0], (after[1]-before[1])/1e6
+            results.append(dict(function=name, connections=n_connections, wall=wall, files=nfiles, MB=mbytes,
+                                files_per_s=nfiles/wall, MB_per_s=mbytes/wall))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        for key, value in saved.items():
+            setattr(ftp_transfer.secretcodes, key, value)
+
+    return results
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the NRT-BFN download functions against a local FTP server.')
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 4], help='numbers of FTP connexions to compare')
+    parser.add_argument('--numdays', type=int, default=8, help='length of the assimilation window (days)')
+    parser.add_argument('--today', type=str, default='2023-04-13', help='experiment date (YYYY-MM-DD)')
+    parser.add_argument('--points', type=int, default=20000, help='observations per synthetic L3 file')
+    parser.add_argument('--latency', type=float, default=0.02, help='delay added to every FTP command (s)')
+    parser.add_argument('--failure-rate', type=float, default=0., help='probability that a RETR drops the connexion')
+    parser.add_argument('--sync', action='store_true', help='use the incremental sync mode')
+    parser.add_argument('--verbose', action='store_true', help='show the messages of the download functions')
+    args = parser.parse_args()
+
+    today = datetime.fromisoformat(args.today)
+    root = tempfile.mkdtemp(prefix='nrt_bfn_ftp_')
+    try:
+        print('Building synthetic archive in '+root)
+        make_synthetic_archive(root, today, args.numdays, points=args.points)
+        server, address = start_server(root, latency=args.latency, failure_rate=args.failure_rate)
+        print('Serving on '+address+' (latency '+str(args.latency)+' s, failure rate '+str(args.failure_rate)+')\n')
+
+        print('{:<24}{:>12}{:>10}{:>8}{:>10}{:>10}{:>10}'.format('function', 'connections', 'wall (s)', 'files', 'MB', 'files/s', 'MB/s'))
+        for n_connections in args.connections:
+            for r in run_benchmark(address, today, args.numdays, n_connections, sync=args.sync, verbose=args.verbose):
+                print('{function:<24}{connections:>12}{wall:>10.2f}{files:>8}{MB:>10.1f}{files_per_s:>10.1f}{MB_per_s:>10.1f}'.format(**r))
+        server.close_all()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
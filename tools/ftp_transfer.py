@@ -1,4 +1,4 @@
-def ftp_cmems_download_month(ftp, product_path, dataset, year, month):
+def ftp_cmems_download_month(ftp, product_path, dataset, year, month, local_dir = None, limiter = None, window = None, manifest = None):
 
     """ Download all data files in a month repository on an ftp server
 
@@ -8,11 +8,20 @@ def ftp_cmems_download_month(ftp, product_path, dataset, year, month):
         dataset (string): Name of dataset to download within product
         year (string): year of data to download
         month (string): month of data to download
+        local_dir (string, optional): Folder where the files are written. Default is the current working directory.
+        limiter (BandwidthLimiter, optional): Shared bandwidth limiter throttling the transfer. Default is None (no cap).
+        window (tuple, optional): (first_day, last_day) datetimes. If given, only the files whose data date
+            (encoded in the filename) falls within the window are considered. Default is None (whole month).
+        manifest (tools.manifest.Manifest, optional): Manifest of the dataset. If given, files that did not change
+            on the server since they were last downloaded are reused instead of downloaded. Default is None.
 
     Returns:
         None
     """
 
+    if local_dir is None:
+        local_dir = os.getcwd()
+
     # Change CMEMS directory to the product we want (find the path in the catalogue)
     ftp.cwd(product_path+dataset)
     if(year in ftp.nlst()):
@@ -25,12 +34,30 @@ def ftp_cmems_download_month(ftp, product_path, dataset, year, month):
             ftp.cwd(month)
 
             # Set the name of the file to download
-            filenames = ftp.nlst()
-            for filename in filenames:
+            if manifest is not None:
+                listing = list_remote_files(ftp)
+            else:
+                listing = {filename: (None, None) for filename in ftp.nlst()}
+
+            for filename, (size, modify) in listing.items():
+                if window is not None and not in_window(filename, window):
+                    continue
+                local_path = os.path.join(local_dir, filename)
+
+                if manifest is not None and manifest.restore(filename, size, modify, local_path):
+                    print('[up to date] '+filename)
+                    continue
+
                 print('Retreiving data for '+filename)
 
-                # Download the file
-                ftp.retrbinary("RETR "+filename, open(filename, 'wb').write)
+                # Download the file. A copy restore did not validate is stale (e.g. changed in place on the server with the
+                # same size): it is removed first, so that it is never read nor recorded under the new timestamp if the
+                # transfer fails. The manifest is only updated after a complete transfer.
+                if os.path.lexists(local_path):
+                    os.remove(local_path)
+                retrieve_file(ftp, filename, local_path, limiter, size, modify)
+                if manifest is not None:
+                    manifest.record(filename, size, modify, local_path)
         
         else:
             print('[Warning] No data folder for month '+ month + ' yet.')
@@ -39,7 +66,44 @@ def ftp_cmems_download_month(ftp, product_path, dataset, year, month):
 
 
 import os
-from ftplib import error_perm
+from ftplib import error_perm, Error
+from tools.manifest import Manifest, in_window
+from tools.obs_cache import ObsCache, evict_cache
+
+def list_remote_files(ftp):
+
+    """
+    Lists the files of the current FTP directory with their size and modification time.
+
+    Args:
+        ftp (ftplib.FTP): FTP connexion, already in the directory to list.
+
+    Returns:
+        dict: {filename: (size, modify)} with the size in bytes and the MDTM timestamp ('YYYYMMDDHHMMSS') as a string.
+            Facts the server does not provide are set to None.
+
+    MLSD is used when the server supports it (a single command for the whole folder), otherwise the
+    listing falls back to NLST followed by one SIZE and one MDTM command per file.
+    """
+
+    try:
+        return {name: (int(facts['size']) if 'size' in facts else None, facts.get('modify', '')[:14] or None)
+                for name, facts in ftp.mlsd(facts = ['type', 'size', 'modify']) if facts.get('type', 'file') == 'file'}
+    except error_perm:
+        pass
+
+    listing = {}
+    for name in ftp.nlst():
+        try:
+            size = ftp.size(name)
+        except error_perm:
+            size = None
+        try:
+            modify = ftp.sendcmd('MDTM '+name).split()[-1][:14]
+        except error_perm:
+            modify = None
+        listing[name] = (size, modify)
+    return listing
 
 def place_files(ftp, path):
     """
@@ -82,6 +146,149 @@ def place_files(ftp, path):
             print("CWD", "..")
             ftp.cwd("..")
 
+def upload_plan(path):
+
+    """
+    Lists the folders and files to upload from a local directory tree.
+
+    Args:
+        path (str): The local path to the directory to upload.
+
+    Returns:
+        tuple: (folders, files) with the relative paths of the subfolders (parents listed before their children) and
+            (relative path, size in bytes) pairs for the files, largest first.
+    """
+
+    folders, files = [], []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        relative = os.path.relpath(dirpath, path)
+        if relative != '.':
+            folders.append(relative.replace(os.sep, '/'))
+        for name in filenames:
+            relative_file = os.path.relpath(os.path.join(dirpath, name), path).replace(os.sep, '/')
+            files.append((relative_file, os.path.getsize(os.path.join(dirpath, name))))
+    files.sort(key = lambda item: -item[1])
+    return folders, files
+
+def remote_size(ftp, remote_path):
+
+    """ Returns the size of a remote file in bytes, or None if it does not exist. """
+
+    ftp.voidcmd('TYPE I')
+    try:
+        return ftp.size(remote_path)
+    except error_perm:
+        return None
+
+def store_file(ftp, local_path, remote_path, limiter = None):
+
+    """
+    Uploads a single file, resuming an interrupted upload and publishing it atomically.
+
+    Args:
+        ftp (ftplib.FTP): FTP connexion.
+        local_path (str): Path of the local file.
+        remote_path (str): Absolute path of the file on the server.
+        limiter (BandwidthLimiter, optional): Shared bandwidth limiter. Default is None (no cap).
+
+    Returns:
+        bool: True if the file was uploaded, False if the remote file already had the same size and was skipped.
+
+    The file is uploaded to '<remote_path>.part', resuming from its current length (REST offset) if a previous
+    upload was interrupted, then renamed onto remote_path once the remote size matches the local size, so that the
+    previous version stays available until it is replaced.
+    """
+
+    size = os.path.getsize(local_path)
+    if remote_size(ftp, remote_path) == size:
+        return False
+
+    part_path = remote_path+'.part'
+    offset = remote_size(ftp, part_path) or 0
+    if offset > size:
+        offset = 0
+
+    def callback(block):
+        if limiter is not None:
+            limiter.consume(len(block))
+
+    with open(local_path, 'rb') as f:
+        f.seek(offset)
+        ftp.storbinary('STOR '+part_path, f, callback = callback, rest = offset or None)
+
+    if remote_size(ftp, part_path) != size:
+        raise IncompleteTransfer(remote_path+': upload incomplete')
+
+    # RNFR/RNTO replaces an existing file on most servers, the previous version is only deleted on those which refuse
+    try:
+        ftp.rename(part_path, remote_path)
+    except error_perm:
+        try:
+            ftp.delete(remote_path)
+        except error_perm:
+            pass
+        ftp.rename(part_path, remote_path)
+    return True
+
+def place_files_parallel(host, username, password, remote_root, path, n_connections = 4, retries = 3, max_bandwidth = None):
+
+    """
+    Uploads all files and subfolders in the given path to a directory of an FTP server, over several connexions.
+
+    Args:
+        host (str): Address of the FTP server ('host' or 'host:port').
+        username (str): FTP login.
+        password (str): FTP password.
+        remote_root (str): Absolute path of the target directory on the server (it must exist).
+        path (str): The local path to the directory containing files and subfolders to upload.
+        n_connections (int, optional): Number of simultaneous FTP connexions. Default is 4.
+        retries (int, optional): Number of retries of a file after a transfer error. Default is 3.
+        max_bandwidth (float, optional): Global upload rate cap in bytes per second. Default is None (no cap).
+
+    Returns:
+        None
+
+    Unlike 'place_files', the directory plan is built once: the remote subfolders are created first on a single
+    connexion, then the files are uploaded concurrently with absolute remote paths (no CWD per folder), largest first.
+    Files whose remote size already matches are skipped, interrupted uploads are resumed, and every file is only
+    published under its final name once complete (see 'store_file').
+    """
+
+    folders, files = upload_plan(path)
+    pool = FTPPool(host, username, password, size = n_connections)
+    limiter = BandwidthLimiter(max_bandwidth)
+
+    def make_folders(ftp):
+        for folder in folders:
+            print("MKD", folder)
+            try:
+                ftp.mkd(remote_root+'/'+folder)
+            # ignore "directory already exists"
+            except error_perm as e:
+                if not e.args[0].startswith('550'):
+                    raise
+
+    pool.run(make_folders, retries = retries)
+
+    def upload(relative_path):
+        uploaded = pool.run(lambda ftp: store_file(ftp, os.path.join(path, relative_path), remote_root+'/'+relative_path, limiter), retries = retries)
+        print("STOR" if uploaded else "SKIP", relative_path)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers = n_connections) as executor:
+        futures = {executor.submit(upload, relative_path): relative_path for relative_path, size in files}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except all_errors as e:
+                print('[Error] Upload of '+futures[future]+' failed: '+str(e).strip())
+                errors.append(e)
+
+    pool.close()
+    if errors:
+        raise errors[0]
+
 from tools.secretcodes import get_secretcodes
 
 # FIXME! 
@@ -105,7 +312,7 @@ secretcodes = SecretCodes(cmems_username = cmems_username, cmems_password = cmem
 
 from ftplib import FTP
 
-def ftp_to_ifremer(name_experiment, today, currdir):
+def ftp_to_ifremer(name_experiment, today, currdir, n_connections = 4, retries = 3, host = 'ftp.ifremer.fr'):
 
     """
     Uploads files to the IFREMER FTP server for a specific experiment.
@@ -114,14 +321,17 @@ def ftp_to_ifremer(name_experiment, today, currdir):
         name_experiment (str): The name of the experiment.
         today (datetime.datetime): The current experiment date.
         currdir (str): The current working directory.
+        n_connections (int, optional): Number of simultaneous FTP connexions for the upload. Default is 4.
+        retries (int, optional): Number of retries of a file after a transfer error. Default is 3.
+        host (str, optional): Address of the IFREMER FTP server ('host' or 'host:port'). Default is 'ftp.ifremer.fr'.
 
     Returns:
         None
 
     The function connects to the IFREMER FTP server using the provided credentials and navigates to
     the 'MEDSSH_BFN' directory. It creates a subdirectory with the current date in the 'MEDSSH_BFN'
-    directory, then, it calls the 'place_files' function to upload the files to the FTP server. 
-    Finally, it closes the FTP connection.
+    directory (if it does not exist yet) and closes the FTP connection. Then, it calls the 'place_files_parallel'
+    function to upload the files to the FTP server over its own connexions.
 
     Note:
         - The 'secretcodes' module must contain the 'ifremer_username' and 'ifremer_password' variables
@@ -133,22 +343,274 @@ def ftp_to_ifremer(name_experiment, today, currdir):
     password = secretcodes.ifremer_password
 
     # Connect to the ftp server
-    ftp = FTP('ftp.ifremer.fr',username,password)
+    ftp = open_ftp(host,username,password)
     ftp.cwd('MEDSSH_BFN')
 
-    ftp.mkd(today.strftime('%Y%m%d'))
+    # ignore "directory already exists", e.g. when re-delivering a date
+    try:
+        ftp.mkd(today.strftime('%Y%m%d'))
+    except error_perm as e:
+        if not e.args[0].startswith('550'):
+            raise
     ftp.cwd(today.strftime('%Y%m%d'))
+    remote_root = ftp.pwd()
 
-    repo_to_upload = currdir+'/maps_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'
-    place_files(ftp, repo_to_upload)
-
+    # The upload connexions are opened by place_files_parallel, this one would sit idle (and time out) meanwhile
     print('Closing connexion :')
     ftp.quit()
 
+    repo_to_upload = currdir+'/maps_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'
+    place_files_parallel(host, username, password, remote_root, repo_to_upload, n_connections = n_connections, retries = retries)
+
 import numpy as np
 from datetime import timedelta
+import time
+import threading
+import queue
+from ftplib import all_errors
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def download_nadirs_cmems(name_experiment, currdir, today, numdays, datasets, dataset_l4):
+def open_ftp(host, username, password):
+
+    """
+    Opens a connexion to an FTP server.
+
+    Args:
+        host (str): Address of the FTP server, optionally followed by the port ('host:port').
+        username (str): FTP login.
+        password (str): FTP password.
+
+    Returns:
+        ftplib.FTP: The logged-in FTP connexion.
+    """
+
+    hostname, _, port = host.partition(':')
+    ftp = FTP()
+    ftp.connect(hostname, int(port) if port else 21)
+    ftp.login(username, password)
+    return ftp
+
+class IncompleteTransfer(Error):
+    """ Raised when a downloaded file does not match the remote size or is not a valid NetCDF file. """
+
+def is_netcdf(path):
+
+    """
+    Checks the header of a file for the NetCDF classic (CDF1/2/5) or NetCDF-4 (HDF5) signatures.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        bool: True if the file starts with a NetCDF signature.
+    """
+
+    with open(path, 'rb') as f:
+        header = f.read(8)
+    return header[:3] == b'CDF' and header[3:4] in (b'\x01', b'\x02', b'\x05') or header == b'\x89HDF\r\n\x1a\n'
+
+def retrieve_file(ftp, remote_name, local_path, limiter = None, size = None, modify = None):
+
+    """
+    Downloads a single file from the FTP server, resuming a previously interrupted transfer if any.
+
+    Args:
+        ftp (ftplib.FTP): FTP connexion, already in the directory holding the file.
+        remote_name (str): Name (or path) of the file on the server.
+        local_path (str): Where to write the file locally.
+        limiter (BandwidthLimiter, optional): Shared bandwidth limiter. Default is None (no cap).
+        size (int, optional): Size of the remote file in bytes, if already known from the listing. Default is None (asked to the server).
+        modify (str, optional): MDTM timestamp of the remote file, if already known from the listing. Default is None (asked to the server).
+
+    Returns:
+        None
+
+    Raises:
+        IncompleteTransfer: If the downloaded file is shorter or longer than the remote file, or is not a valid NetCDF file.
+
+    The file is always transferred: whether a download is needed is decided by the caller (e.g. from a manifest). The data is
+    written to '<local_path>.part', which is only renamed to local_path once its size and (for '.nc' files) its NetCDF header have
+    been checked, so that an interrupted download never leaves a truncated file behind. The size and MDTM timestamp of the remote
+    file are kept next to it ('<local_path>.part.info'): a '.part' file left by an interrupted transfer of the same remote version is
+    resumed from its current length using a REST offset, and one of another version (or of unknown origin) is discarded.
+    """
+
+    ftp.voidcmd('TYPE I')
+    if size is None:
+        try:
+            size = ftp.size(remote_name)
+        except error_perm:
+            size = None
+    if modify is None:
+        try:
+            modify = ftp.sendcmd('MDTM '+remote_name).split()[-1][:14]
+        except error_perm:
+            modify = None
+
+    part_path = local_path+'.part'
+    info_path = part_path+'.info'
+    version = str(size)+' '+str(modify)
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if offset:
+        previous = None
+        if os.path.isfile(info_path):
+            with open(info_path) as f:
+                previous = f.read()
+        # Only resume the same, identifiable, remote version
+        if size is None or modify is None or previous != version or offset > size:
+            offset = 0
+    with open(info_path, 'w') as f:
+        f.write(version)
+
+    with open(part_path, 'ab' if offset else 'wb') as f:
+        def write(block):
+            if limiter is not None:
+                limiter.consume(len(block))
+            f.write(block)
+        if offset:
+            print('Resuming '+remote_name+' from byte '+str(offset))
+        ftp.retrbinary("RETR "+remote_name, write, rest = offset or None)
+
+    if size is not None and os.path.getsize(part_path) != size:
+        raise IncompleteTransfer(remote_name+': got '+str(os.path.getsize(part_path))+' bytes out of '+str(size))
+    if local_path.endswith('.nc') and not is_netcdf(part_path):
+        os.remove(part_path)
+        os.remove(info_path)
+        raise IncompleteTransfer(remote_name+': not a valid NetCDF file')
+    os.replace(part_path, local_path)
+    os.remove(info_path)
+
+class BandwidthLimiter:
+
+    """
+    Token bucket shared between download workers to cap the total transfer rate.
+
+    Args:
+        max_bytes_per_s (float, optional): Maximum aggregated rate in bytes per second. None disables the cap.
+    """
+
+    def __init__(self, max_bytes_per_s = None):
+        self.rate = max_bytes_per_s
+        self.tokens = max_bytes_per_s or 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last)*self.rate)
+            self.last = now
+            self.tokens -= nbytes
+            wait = -self.tokens/self.rate if self.tokens < 0 else 0
+        # Sleep outside the lock so that other workers can keep refilling the bucket
+        if wait > 0:
+            time.sleep(wait)
+
+class FTPPool:
+
+    """
+    Fixed-size pool of FTP connexions to the same server, opened lazily and shared between threads.
+
+    Args:
+        host (str): Address of the FTP server ('host' or 'host:port').
+        username (str): FTP login.
+        password (str): FTP password.
+        size (int): Maximum number of simultaneous connexions. Default is 4.
+    """
+
+    def __init__(self, host, username, password, size = 4):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.Semaphore(size)
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return open_ftp(self.host, self.username, self.password)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, ftp, broken = False):
+        # Broken connexions are dropped, the next acquire will open a fresh one
+        if broken:
+            try:
+                ftp.close()
+            except all_errors:
+                pass
+        else:
+            self.idle.put(ftp)
+        self.slots.release()
+
+    def run(self, task, retries = 3, backoff = 2.):
+
+        """
+        Runs task(ftp) on a pooled connexion, retrying on a fresh connexion after FTP or network errors.
+
+        Args:
+            task (callable): Function taking an FTP connexion as only argument.
+            retries (int): Number of retries after the first failure. Default is 3.
+            backoff (float): Base waiting time (s) between attempts, doubled after each failure. Default is 2.
+
+        Returns:
+            The value returned by task.
+        """
+
+        for attempt in range(retries+1):
+            ftp = self.acquire()
+            try:
+                result = task(ftp)
+            except all_errors as e:
+                self.release(ftp, broken = True)
+                if attempt == retries:
+                    raise
+                print('[Warning] '+str(e).strip()+' - retrying ('+str(attempt+1)+'/'+str(retries)+')')
+                time.sleep(backoff*2**attempt)
+            except BaseException:
+                self.release(ftp, broken = True)
+                raise
+            else:
+                self.release(ftp)
+                return result
+
+    def close(self):
+        while not self.idle.empty():
+            ftp = self.idle.get_nowait()
+            try:
+                ftp.quit()
+            except all_errors:
+                ftp.close()
+
+def months_to_download(today, first_day):
+
+    """
+    Lists the (year, month) folders spanned by the period [first_day, today], most recent first.
+
+    Args:
+        today (datetime.datetime): Last day of the period.
+        first_day (datetime.datetime): First day of the period.
+
+    Returns:
+        list: (year, month) tuples of strings, as named on the CMEMS FTP server (month not zero-padded).
+    """
+
+    months = []
+    year, month = today.year, today.month
+    while (year, month) >= (first_day.year, first_day.month):
+        months.append((str(year), str(month)))
+        year, month = (year, month-1) if month > 1 else (year-1, 12)
+    return months
+
+def download_nadirs_cmems(name_experiment, currdir, today, numdays, datasets, dataset_l4, n_connections = 4, max_bandwidth = None, retries = 3, host = 'nrt.cmems-du.eu', sync = False, cache_dir = None, cache_max_size = None, cache_max_age = None):
 
     """
     Downloads nadir data from the CMEMS FTP server for a specific experiment.
@@ -159,15 +621,31 @@ def download_nadirs_cmems(name_experiment, currdir, today, numdays, datasets, da
         today (datetime.datetime): The current experiment date.
         numdays (int): The minimum number of days to go back for data download.
         datasets (list): A list of dataset names to download (alongtrack data).
-        dataset_l4 (str): The name of the L4 dataset to download.
+        dataset_l4 (str): The name of the L4 dataset to download. None to download alongtrack data only.
+        n_connections (int, optional): Number of simultaneous FTP connexions (and download workers). Default is 4.
+        max_bandwidth (float, optional): Global download rate cap in bytes per second, shared by all workers. Default is None (no cap).
+        retries (int, optional): Number of retries of a dataset/month folder after a transfer error. Default is 3.
+        host (str, optional): Address of the CMEMS NRT FTP server ('host' or 'host:port'). Default is 'nrt.cmems-du.eu'.
+        sync (bool, optional): Incremental mode. Only the files whose date is within [today-numdays, today] are
+            considered, and those already downloaded by a previous run and unchanged on the server are reused
+            instead of transferred again. Default is False (whole month folders are downloaded).
+        cache_dir (str, optional): Folder of a shared observation cache (see tools.obs_cache). If given, sync mode is
+            used and each file is stored once in the cache, the daily input folders only holding hardlinks to it.
+            Default is None (manifests in 'input_<name_experiment>/manifest/', files stored in each daily folder).
+        cache_max_size (float, optional): Size cap of the cache in bytes, enforced after the download. Default is None.
+        cache_max_age (float, optional): Cached files unused for more than cache_max_age days are evicted. Default is None.
 
     Returns:
         None
 
     The function connects to the CMEMS FTP server using the provided credentials and downloads nadir
     data for the specified datasets. It creates the necessary directories to store the downloaded data
-    within the experiment's input folder. It then iterates over the months starting from the
-    current month and goes back as many months as needed to cover 'numdays'. 
+    within the experiment's input folder. Every dataset/month folder needed to cover 'numdays' (L3 tracks
+    and the L4 product) is handled by its own worker, the workers sharing a pool of 'n_connections' FTP
+    connexions, so that the latency-bound transfers of the different datasets overlap.
+
+    In sync mode, a manifest per dataset is kept in 'input_<name_experiment>/manifest/' with the size, MDTM
+    timestamp and checksum of every downloaded file, and where it was stored.
 
     Note:
         - The 'secretcodes' module must contain the 'cmems_username' and 'cmems_password' variables
@@ -178,58 +656,65 @@ def download_nadirs_cmems(name_experiment, currdir, today, numdays, datasets, da
     username = secretcodes.cmems_username
     password = secretcodes.cmems_password
     
-    # Connect to the ftp server
-    ftp = FTP('nrt.cmems-du.eu',username,password)
-
     # Choose dates to download
     first_day = today - timedelta(days=numdays)
-    # Download all L3 products
+    months = months_to_download(today, first_day)
 
-    for i in np.arange(0,len(datasets)):
+    # One task per dataset/month folder : all L3 products, then DUACS L4 product
+    products = [('/Core/SEALEVEL_GLO_PHY_L3_NRT_OBSERVATIONS_008_044/', dataset) for dataset in datasets]
+    if dataset_l4 is not None:
+        products.append(('/Core/SEALEVEL_GLO_PHY_L4_NRT_OBSERVATIONS_008_046/', dataset_l4))
 
-        os.makedirs(currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+datasets[i], exist_ok = True)
-        os.chdir(currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+datasets[i])
+    tasks = []
+    for product_path, dataset in products:
+        local_dir = currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+dataset
+        os.makedirs(local_dir, exist_ok = True)
+        for year, month in months:
+            tasks.append((product_path, dataset, year, month, local_dir))
 
-        # go through each month folder in case obs span over several months
-        m=0
-        month = today.month
-        year = today.year
-        while (((month != first_day.month) | (year != first_day.year) | (m==0))):
-            month = (today.month-m)%12
-            if month == 0:
-                month = 12
-                year = year-1
-            ftp_cmems_download_month(ftp, '/Core/SEALEVEL_GLO_PHY_L3_NRT_OBSERVATIONS_008_044/', datasets[i], str(year), str(month))
-            os.chdir(currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+datasets[i])
-            m += 1
+    # Connect to the ftp server
+    pool = FTPPool(host, username, password, size = n_connections)
+    limiter = BandwidthLimiter(max_bandwidth)
+
+    sync = sync or cache_dir is not None
+    window = (first_day, today) if sync else None
+    manifests = {}
+    for product_path, dataset in products:
+        if cache_dir is not None:
+            manifests[dataset] = ObsCache(cache_dir, dataset)
+        elif sync:
+            manifests[dataset] = Manifest(currdir+'/input_'+name_experiment+'/manifest/'+dataset+'.json')
+
+    def download_folder(product_path, dataset, year, month, local_dir):
+        pool.run(lambda ftp: ftp_cmems_download_month(ftp, product_path, dataset, year, month, local_dir, limiter, window, manifests.get(dataset)), retries = retries)
+        return dataset
+
+    errors = []
+    with ThreadPoolExecutor(max_workers = n_connections) as executor:
+        futures = {executor.submit(download_folder, *task): task for task in tasks}
+        for future in as_completed(futures):
+            product_path, dataset, year, month, local_dir = futures[future]
+            try:
+                future.result()
+            except all_errors as e:
+                print('[Error] Download of '+dataset+' '+year+'/'+month+' failed: '+str(e).strip())
+                errors.append(e)
 
-    os.chdir(currdir)
-    print('Obs data downloaded successfully')
+    pool.close()
+    for manifest in manifests.values():
+        manifest.save()
+    if cache_dir is not None and (cache_max_size is not None or cache_max_age is not None):
+        evict_cache(cache_dir, cache_max_size, cache_max_age)
+    if errors:
+        raise errors[0]
 
-    # Download DUACS L4 product
-    print('Retreiving data for dataset '+dataset_l4)
+    if len(datasets) > 0:
+        print('Obs data downloaded successfully')
+    if dataset_l4 is not None:
+        print('DUACS L4 data downloaded successfully')
 
-    os.makedirs(currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+dataset_l4, exist_ok = True)
-    os.chdir(currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+dataset_l4)
-    
-    m=0
-    month = today.month
-    year = today.year
-    while (((month != first_day.month) | (year != first_day.year) | (m==0))):
-        month = (today.month-m)%12
-        if month == 0:
-            month = 12
-            year = year-1
-        ftp_cmems_download_month(ftp, '/Core/SEALEVEL_GLO_PHY_L4_NRT_OBSERVATIONS_008_046/', dataset_l4, str(year), str(month))
-        os.chdir(currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+dataset_l4)
-        m += 1
-
-    os.chdir(currdir)
-    print('DUACS L4 data downloaded successfully')
 
-    ftp.quit()
-
-def download_mdt(name_experiment, currdir, dataset_mdt):
+def download_mdt(name_experiment, currdir, dataset_mdt, retries = 3, host = 'my.cmems-du.eu'):
 
     """
     Downloads Mean Dynamic Topography (MDT) data from the CMEMS FTP server for a specific experiment.
@@ -238,6 +723,8 @@ def download_mdt(name_experiment, currdir, dataset_mdt):
         name_experiment (str): The name of the experiment.
         currdir (str): The current working directory.
         dataset_mdt (str): The name of the MDT dataset to download.
+        retries (int, optional): Number of times an interrupted transfer is resumed. Default is 3.
+        host (str, optional): Address of the CMEMS MY FTP server ('host' or 'host:port'). Default is 'my.cmems-du.eu'.
 
     Returns:
         None
@@ -255,24 +742,59 @@ def download_mdt(name_experiment, currdir, dataset_mdt):
     password = secretcodes.cmems_password
 
     # Connect to the ftp server
-    ftp = FTP('my.cmems-du.eu',username,password)
+    pool = FTPPool(host, username, password, size = 1)
 
     # Download DUACS L4 product
     print('Downloading MDT')
 
     os.makedirs(currdir+'/input_'+name_experiment+'/', exist_ok = True)
-    os.chdir(currdir+'/input_'+name_experiment+'/')
 
-    ftp.retrbinary("RETR "+"/Core/SEALEVEL_GLO_PHY_MDT_008_063/cnes_obs-sl_glo_phy-mdt_my_0.125deg_P20Y/"+dataset_mdt, open(dataset_mdt, 'wb').write)
+    # Interrupted transfers are resumed on a new connexion
+    pool.run(lambda ftp: retrieve_file(ftp, "/Core/SEALEVEL_GLO_PHY_MDT_008_063/cnes_obs-sl_glo_phy-mdt_my_0.125deg_P20Y/"+dataset_mdt, currdir+'/input_'+name_experiment+'/'+dataset_mdt), retries = retries)
 
-    os.chdir(currdir)
     print('MDT downloaded successfully')
 
-    ftp.quit()
+    pool.close()
 
 import re
 
-def download_swot_nadir(name_experiment, currdir, today):
+def select_latest_versions(filenames, window = None):
+
+    """
+    Selects, among product filenames of the form '<prefix>_<data date>_<upload date>.nc', the most recent upload of each data date.
+
+    Args:
+        filenames (list): Filenames listed on the server.
+        window (tuple, optional): (first_day, last_day) datetimes. If given, only data dates within the window (both included)
+            are kept. Default is None (all dates).
+
+    Returns:
+        list: The selected filenames, sorted by data date.
+
+    The dates of all filenames are parsed at once into an array of (data date, upload date) integer pairs. The pairs are sorted
+    by data date then upload date, so that the latest upload of each data date is the last element of its run of equal data
+    dates. Filenames without the two dates are ignored.
+    """
+
+    pattern = re.compile(r'(\d{8})_(\d{8})\.nc$')
+    matches = [(name, pattern.search(name)) for name in filenames]
+    names = np.array([name for name, match in matches if match is not None])
+    if len(names) == 0:
+        return []
+    dates = np.array([match.groups() for name, match in matches if match is not None], dtype = np.int64)
+
+    if window is not None:
+        in_window = (dates[:,0] >= int(window[0].strftime('%Y%m%d'))) & (dates[:,0] <= int(window[1].strftime('%Y%m%d')))
+        names, dates = names[in_window], dates[in_window]
+        if len(names) == 0:
+            return []
+
+    order = np.lexsort((dates[:,1], dates[:,0]))
+    data_dates = dates[order,0]
+    is_latest = np.append(data_dates[1:] != data_dates[:-1], True)
+    return names[order[is_latest]].tolist()
+
+def download_swot_nadir(name_experiment, currdir, today, numdays = None, retries = 3, host = 'ftp-access.aviso.altimetry.fr'):
 
     """
     Downloads SWOT nadir L3 data from AVISO for a specific experiment.
@@ -281,14 +803,18 @@ def download_swot_nadir(name_experiment, currdir, today):
         name_experiment (str): The name of the experiment.
         currdir (str): The current working directory.
         today (datetime.datetime): The current date.
+        numdays (int, optional): The number of days to go back for data download. Default is None (whole archive).
+        retries (int, optional): Number of times an interrupted transfer is resumed. Default is 3.
+        host (str, optional): Address of the AVISO FTP server ('host' or 'host:port'). Default is 'ftp-access.aviso.altimetry.fr'.
 
     Returns:
         None
 
     The function connects to the AVISO FTP server using the provided credentials and downloads SWOT nadir
-    L3 data for the specified experiment. It retrieves the list of available filenames from the FTP server.
-    It iterates over the filenames and downloads each file using the 'retrbinary' command. Then, it selects
-    the most recent version of the data for each available observation date.
+    L3 data for the specified experiment. It retrieves the list of available filenames from the FTP server
+    and selects, before any transfer, the most recent version of the data for each observation date within
+    [today-numdays, today]. Only those files are downloaded, and older versions left in the folder by a previous
+    run are removed.
 
     Note:
         - The 'secretcodes' module must contain the 'swot_username' and 'swot_password' variables with
@@ -300,67 +826,39 @@ def download_swot_nadir(name_experiment, currdir, today):
     password = secretcodes.swot_password 
 
     # Connect to the ftp server
-    ftp = FTP('ftp-access.aviso.altimetry.fr',username,password)
-    # ftp.cwd('/data/Data/ALTI/DUACS_SWOT_Nadir/L3_Along_track')
-    ftp.cwd('/swot_beta_products/l3_karin_nadir')
+    pool = FTPPool(host, username, password, size = 1)
+    # remote_dir = '/data/Data/ALTI/DUACS_SWOT_Nadir/L3_Along_track'
+    remote_dir = '/swot_beta_products/l3_karin_nadir'
     # https://www.aviso.altimetry.fr/en/data/products/sea-surface-height-products/global/along-track-sea-level-heights.html
     # https://www.aviso.altimetry.fr/en/data/products/sea-surface-height-products/global/swot-l3-ocean-products.html 
-    filenames = ftp.nlst()
+    filenames = pool.run(lambda ftp: ftp.nlst(remote_dir), retries = retries)
+    filenames = [os.path.basename(filename) for filename in filenames]
+
+    # Keep only the latest upload of each data date within the assimilation window
+    window = (today - timedelta(days=numdays), today) if numdays is not None else None
+    keeper_names = select_latest_versions(filenames, window)
 
     # Download SWOT nadir product
     dataset_swot_n = 'nrt_global_swonc_phy_l3_1hz'
     print('Retreiving data for dataset '+dataset_swot_n)
 
-    os.makedirs(currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+dataset_swot_n, exist_ok = True)
-    os.chdir(currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+dataset_swot_n)
+    local_dir = currdir+'/input_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+dataset_swot_n
+    os.makedirs(local_dir, exist_ok = True)
 
     # Set the name of the file to download
-    for filename in filenames:
+    for filename in keeper_names:
         print('Retreiving data for '+filename)
 
-        # Download the file
-        ftp.retrbinary("RETR "+filename, open(filename, 'wb').write)
+        # Download the file, interrupted transfers are resumed on a new connexion
+        pool.run(lambda ftp: retrieve_file(ftp, remote_dir+'/'+filename, os.path.join(local_dir, filename)), retries = retries)
 
     print(dataset_swot_n+' data downloaded successfully')
-    ftp.quit()
-    
-    # Sort SWOT nadir files to keep only the right ones
-    # Get all combinations of data dates and upload dates from filenames
-    i=0
-    all_date_combos = np.zeros((len(filenames),2))
-    for filename in filenames:
-        all_date_combos[i,0] = re.findall(r'\d+', filename)[2]
-        all_date_combos[i,1] = re.findall(r'\d+', filename)[3]
-        i=i+1
-    all_date_combos = all_date_combos[all_date_combos[:,0].argsort()]
-
-    # Makes a list of all data dates available, regardless of upload date
-    dates_data = np.zeros((0,0))
-    for date in all_date_combos[:,0]:
-        if not(any(dates_data==date)):
-            dates_data = np.append(dates_data, date)
-
-    # For each data date, choose the latest upload date
-    i=0
-    most_recent_uploads = np.zeros((len(dates_data),2))
-    for date in dates_data:
-        date_i_uploads = all_date_combos[all_date_combos[:,0]==date, :]
-        most_recent_uploads[i,0] = date 
-        most_recent_uploads[i,1] = max(date_i_uploads[:,1])
-        # print('At date '+str(most_recent_uploads[i,0])+', uploads available : '+str(date_i_uploads[:,1])+', keeping : '+str(most_recent_uploads[i,1]))
-        i=i+1
-    # most_recent_uploads # this contains pairs of data dates and upload dates to KEEP. all other should be deleted.
-
-    keeper_names = []
-    for i in np.arange(0,len(most_recent_uploads)):
-        keeper_names = np.append(keeper_names, 'nrt_global_swonc_phy_l3_1hz_'+str(int(most_recent_uploads[i,0]))+'_'+str(int(most_recent_uploads[i,1]))+'.nc')
-
-    for filename in filenames:
-        if not(filename in keeper_names):
+    pool.close()
+
+    # Remove superseded versions downloaded by a previous run
+    for filename in os.listdir(local_dir):
+        if filename.startswith(dataset_swot_n) and filename not in keeper_names and len(select_latest_versions([filename])) == 1:
             print('[deleting] '+filename)
-            os.remove(filename)
-        else:
-            print('[keeping] '+filename)
+            os.remove(os.path.join(local_dir, filename))
 
     print('[SWOT nadir input files ready]')
-    os.chdir(currdir)
\ No newline at end of file
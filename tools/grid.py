@@ -0,0 +1,121 @@
+import os
+import hashlib
+import threading
+import numpy as np
+
+from tools.vars import geostrophic_coefficients
+
+class GridMetrics:
+
+    """
+    Metrics of a regular lon/lat grid : spherical grid spacings, Coriolis parameter and the stencil coefficients of the
+    operators of tools.vars. They are computed once per grid and can be passed directly to those operators (metrics=...).
+
+    Args:
+        lon (1D array): Longitudes of the grid (°).
+        lat (1D array): Latitudes of the grid (°).
+        g (float): Acceleration of gravity (m.s-2). Default is 9.81.
+        earth_rad (float): Radius of the Earth (m). Default is 6.371e6.
+        earth_w (float): Rotation rate of the Earth (rad/s). Default is 2π/86400.
+
+    Attributes:
+        dy, dx (2D arrays): Height and width of the grid points (m), with Neumann conditions at the boundaries.
+        f (2D array): Coriolis parameter (s-1).
+        coefs (dict): Stencil coefficients (see tools.vars.geostrophic_coefficients).
+
+    Use GridMetrics.from_axes to get the metrics of a grid: they are memoized in the process, and optionally on disk.
+    """
+
+    memo = {}
+    memo_lock = threading.Lock()
+
+    def __init__(self, lon, lat, g = 9.81, earth_rad = 6.371e6, earth_w = 2*np.pi/86400):
+        self.lon = np.asarray(lon, dtype = np.float64)
+        self.lat = np.asarray(lat, dtype = np.float64)
+        self.g = g
+
+        # Create the dy, dx and f grids based on physical parameters
+        x, y = np.meshgrid(self.lon, self.lat)
+
+        self.dy = np.ones(y.shape)
+        self.dx = np.ones(x.shape)
+
+        self.dy[1:-1,:]=earth_rad*2*np.pi/360*(y[1:-1,:]-y[0:-2,:])
+        self.dx[:,1:-1]=earth_rad*2*np.pi/360*(x[:,1:-1]-x[:,0:-2])*np.cos(((y[:,1:-1]+y[:,0:-2])/2)*np.pi/180)
+
+        # Neumann condition at boundaries
+        self.dy[0,:]=self.dy[1,:]
+        self.dy[-1,:]=self.dy[-2,:]
+        self.dx[:,0]=self.dx[:,1]
+        self.dx[:,-1]=self.dx[:,-2]
+
+        self.f=2*earth_w*np.sin(y*np.pi/180)
+
+        self.coefs = geostrophic_coefficients(self.dy, self.dx, self.g, self.f)
+
+    @staticmethod
+    def key(lon, lat, g = 9.81):
+
+        """ Identifier of a grid, from the values of its axes. """
+
+        md5 = hashlib.md5()
+        md5.update(np.ascontiguousarray(lon, dtype = np.float64).tobytes())
+        md5.update(np.ascontiguousarray(lat, dtype = np.float64).tobytes())
+        md5.update(str(g).encode())
+        return md5.hexdigest()
+
+    @classmethod
+    def from_axes(cls, lon, lat, g = 9.81, cache_dir = None):
+
+        """
+        Returns the metrics of a grid, computing them only if they are not known yet.
+
+        Args:
+            lon (1D array): Longitudes of the grid (°).
+            lat (1D array): Latitudes of the grid (°).
+            g (float): Acceleration of gravity (m.s-2). Default is 9.81.
+            cache_dir (str, optional): Folder where the metrics are also saved ('grid_metrics_<key>.npz'), e.g. the input
+                folder of the experiment, so that later runs on the same grid load them. Default is None (memory only).
+
+        Returns:
+            GridMetrics: The metrics of the grid.
+        """
+
+        key = cls.key(lon, lat, g)
+        with cls.memo_lock:
+            if key in cls.memo:
+                return cls.memo[key]
+
+        path = os.path.join(cache_dir, 'grid_metrics_'+key+'.npz') if cache_dir is not None else None
+        if path is not None and os.path.isfile(path):
+            metrics = cls.load(path)
+        else:
+            metrics = cls(lon, lat, g)
+            if path is not None:
+                metrics.save(path)
+
+        with cls.memo_lock:
+            return cls.memo.setdefault(key, metrics)
+
+    def save(self, path):
+
+        """ Saves the metrics to a .npz file (atomically). """
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        arrays = dict(lon = self.lon, lat = self.lat, g = self.g, dy = self.dy, dx = self.dx, f = self.f)
+        arrays.update({'coef_'+name: value for name, value in self.coefs.items()})
+        with open(path+'.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(path+'.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+
+        """ Loads metrics saved with GridMetrics.save. """
+
+        with np.load(path) as data:
+            metrics = cls.__new__(cls)
+            metrics.lon, metrics.lat, metrics.g = data['lon'], data['lat'], float(data['g'])
+            metrics.dy, metrics.dx, metrics.f = data['dy'], data['dx'], data['f']
+            metrics.coefs = {name[5:]: data[name] for name in data.files if name.startswith('coef_')}
+        return metrics
@@ -0,0 +1,150 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import threading
+from datetime import datetime
+
+def date_from_filename(filename):
+
+    """
+    Extracts the data date encoded in an altimetry product filename.
+
+    Args:
+        filename (str): Name of the file, e.g. 'nrt_global_al_phy_l3_20230410_20230416.nc'.
+
+    Returns:
+        datetime.datetime: The first YYYYMMDD date found in the name (data date), or None if there is none.
+    """
+
+    match = re.search(r'(?<!\d)(\d{8})(?!\d)', filename)
+    if match is None:
+        return None
+    try:
+        return datetime.strptime(match.group(1), '%Y%m%d')
+    except ValueError:
+        return None
+
+def in_window(filename, window):
+
+    """
+    Checks whether the data date of a file falls within a time window.
+
+    Args:
+        filename (str): Name of the file.
+        window (tuple): (first_day, last_day) datetimes, both included. Only the dates are compared.
+
+    Returns:
+        bool: True if the file date is in the window. Files without a parsable date are always kept.
+    """
+
+    file_date = date_from_filename(filename)
+    if file_date is None:
+        return True
+    return window[0].date() <= file_date.date() <= window[1].date()
+
+def file_checksum(path, blocksize = 2**20):
+
+    """
+    Computes the MD5 checksum of a local file, reading it by blocks.
+
+    Args:
+        path (str): Path of the file.
+        blocksize (int): Size of the blocks read at once, in bytes. Default is 1 MiB.
+
+    Returns:
+        str: Hexadecimal MD5 digest.
+    """
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+class Manifest:
+
+    """
+    Local record of the files already downloaded for a dataset, shared by consecutive runs.
+
+    Each entry is keyed by the remote filename and stores its size and modification time (MDTM) on the
+    server, the MD5 checksum of the downloaded copy and the local path where it was last written.
+
+    Args:
+        path (str): JSON file holding the manifest. It is created on the first save.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def is_current(self, filename, size, modify):
+
+        """ Returns True if the remote file (size, MDTM timestamp) is the one recorded in the manifest. """
+
+        with self.lock:
+            entry = self.entries.get(filename)
+        return entry is not None and entry['size'] == size and entry['modify'] == modify
+
+    def restore(self, filename, size, modify, local_path):
+
+        """
+        Makes an unchanged, already downloaded file available at local_path without downloading it again.
+
+        Args:
+            filename (str): Remote filename.
+            size (int): Size of the remote file, in bytes.
+            modify (str): MDTM timestamp of the remote file.
+            local_path (str): Where the file is expected for the current run.
+
+        Returns:
+            bool: True if local_path now holds a verified copy of the remote file, False if it has to be downloaded.
+
+        The file is reused if it is already at local_path, otherwise it is hardlinked (or copied) from the
+        location where it was last downloaded, e.g. the input folder of the previous day. Copies are checked
+        against the recorded checksum.
+        """
+
+        if size is None or not self.is_current(filename, size, modify):
+            return False
+        with self.lock:
+            entry = dict(self.entries[filename])
+
+        for candidate in (local_path, entry['path']):
+            if os.path.isfile(candidate) and os.path.getsize(candidate) == size and file_checksum(candidate) == entry['checksum']:
+                if candidate != local_path:
+                    if os.path.lexists(local_path):
+                        os.remove(local_path)
+                    try:
+                        os.link(candidate, local_path)
+                    except OSError:
+                        shutil.copy2(candidate, local_path)
+                    # Point to the most recent copy, older run folders may be cleaned up
+                    with self.lock:
+                        self.entries[filename]['path'] = os.path.abspath(local_path)
+                return True
+        return False
+
+    def record(self, filename, size, modify, local_path):
+
+        """ Adds or updates the entry of a freshly downloaded file. """
+
+        entry = dict(size = size if size is not None else os.path.getsize(local_path), modify = modify,
+                     checksum = file_checksum(local_path), path = os.path.abspath(local_path))
+        with self.lock:
+            self.entries[filename] = entry
+
+    def save(self):
+
+        """ Writes the manifest to disk (atomically, through a temporary file). """
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+        with self.lock:
+            with open(self.path+'.tmp', 'w') as f:
+                json.dump(self.entries, f, indent = 1, sort_keys = True)
+            os.replace(self.path+'.tmp', self.path)
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import shutil
+from tools.manifest import Manifest, file_checksum
+
+def link_file(source, destination, mode = 'hardlink'):
+
+    """
+    Makes a file of the cache available at another location.
+
+    Args:
+        source (str): Path of the file in the cache.
+        destination (str): Path where the file is expected (e.g. in a daily input folder).
+        mode (str): 'hardlink', 'symlink' or 'copy'. Hardlinks fall back to a copy when the cache is on another
+            filesystem. Default is 'hardlink'.
+
+    Returns:
+        None
+    """
+
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(source), destination)
+        return
+    if mode == 'hardlink':
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, destination)
+
+class ObsCache(Manifest):
+
+    """
+    Content-addressed store of the observation files of a dataset, shared by all the daily run folders.
+
+    Every file is stored once in '<root>/objects/', named after its MD5 checksum, and an index per dataset
+    ('<root>/<dataset>.json') maps the remote filenames to the stored objects, together with their size and
+    MDTM timestamp on the server and the time they were last used. Daily input folders only hold links to
+    the objects. It is a drop-in replacement for tools.manifest.Manifest in the download functions.
+
+    Args:
+        root (str): Folder of the cache, e.g. 'input_<name_experiment>/cache'.
+        dataset (str): Name of the dataset.
+        link (str): How files are exposed in the daily folders: 'hardlink', 'symlink' or 'copy'. Default is 'hardlink'.
+    """
+
+    def __init__(self, root, dataset, link = 'hardlink'):
+        super().__init__(os.path.join(root, dataset+'.json'))
+        self.root = root
+        self.link = link
+        os.makedirs(os.path.join(root, 'objects'), exist_ok = True)
+
+    def object_path(self, checksum):
+        return os.path.join(self.root, 'objects', checksum)
+
+    def restore(self, filename, size, modify, local_path):
+
+        """
+        Links the cached copy of an unchanged remote file to local_path.
+
+        Returns:
+            bool: True if the file was found in the cache, False if it has to be downloaded.
+        """
+
+        if size is None or not self.is_current(filename, size, modify):
+            return False
+        with self.lock:
+            entry = self.entries[filename]
+            source = entry['path']
+            if not (os.path.isfile(source) and os.path.getsize(source) == size):
+                return False
+            entry['last_access'] = time.time()
+        link_file(source, local_path, self.link)
+        return True
+
+    def record(self, filename, size, modify, local_path):
+
+        """ Moves a freshly downloaded file into the cache and links it back to local_path. """
+
+        checksum = file_checksum(local_path)
+        source = self.object_path(checksum)
+        if os.path.isfile(source):
+            os.remove(local_path)
+        else:
+            os.replace(local_path, source)
+        link_file(source, local_path, self.link)
+
+        entry = dict(size = os.path.getsize(source), modify = modify, checksum = checksum, path = source, last_access = time.time())
+        with self.lock:
+            self.entries[filename] = entry
+
+def evict_cache(root, max_size = None, max_age = None):
+
+    """
+    Evicts objects from an observation cache, by age and then by least recent use.
+
+    Args:
+        root (str): Folder of the cache.
+        max_size (float, optional): Maximum total size of the cached objects, in bytes. Default is None (no cap).
+        max_age (float, optional): Objects not used for more than max_age days are removed. Default is None.
+
+    Returns:
+        int: Number of bytes freed in the cache.
+
+    Objects no longer referenced by any index are removed as well. Note that with hardlinks, the disk space of an
+    evicted object is only released once the daily folders linking to it are deleted, and that with symlinks those
+    links become dangling.
+    """
+
+    objects_dir = os.path.join(root, 'objects')
+    if not os.path.isdir(objects_dir):
+        return 0
+
+    indexes = {}
+    last_access = {}
+    for name in os.listdir(root):
+        if name.endswith('.json'):
+            with open(os.path.join(root, name)) as f:
+                indexes[name] = json.load(f)
+            for entry in indexes[name].values():
+                last_access[entry['checksum']] = max(last_access.get(entry['checksum'], 0), entry.get('last_access', 0))
+
+    sizes = {checksum: os.path.getsize(os.path.join(objects_dir, checksum)) for checksum in os.listdir(objects_dir)}
+    now = time.time()
+
+    to_remove = {checksum for checksum in sizes if checksum not in last_access}
+    if max_age is not None:
+        to_remove |= {checksum for checksum, t in last_access.items() if now-t > max_age*86400}
+
+    if max_size is not None:
+        total = sum(size for checksum, size in sizes.items() if checksum not in to_remove)
+        for checksum in sorted(last_access, key = last_access.get):
+            if total <= max_size:
+                break
+            if checksum in sizes and checksum not in to_remove:
+                to_remove.add(checksum)
+                total -= sizes[checksum]
+
+    freed = 0
+    for checksum in to_remove:
+        if checksum in sizes:
+            os.remove(os.path.join(objects_dir, checksum))
+            freed += sizes[checksum]
+
+    for name, entries in indexes.items():
+        kept = {filename: entry for filename, entry in entries.items() if entry['checksum'] not in to_remove}
+        if len(kept) != len(entries):
+            with open(os.path.join(root, name+'.tmp'), 'w') as f:
+                json.dump(kept, f, indent = 1, sort_keys = True)
+            os.replace(os.path.join(root, name+'.tmp'), os.path.join(root, name))
+
+    print('[cache] '+str(len(to_remove))+' objects evicted, '+str(round(freed/1e6, 1))+' MB freed')
+    return freed
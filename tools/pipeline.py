@@ -0,0 +1,155 @@
+import time
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class Pipeline:
+
+    """
+    Minimal scheduler running the stages of an NRT-BFN run concurrently, as soon as the stages they depend on are done.
+
+    Args:
+        max_workers (int): Maximum number of stages running at the same time. Default is 4.
+        profiler (tools.profiling.RunProfiler, optional): If given, every stage is measured by the profiler. Default is None.
+
+    Stages are plain functions without arguments. The value returned by a stage is stored in 'results' under its
+    name, so that later stages can use it. Stages sharing a resource name never run at the same time. Stages using a
+    resource of 'main_thread_resources' ('pyplot': matplotlib is not thread-safe and interactive backends only work on
+    the main thread) are moreover run on the thread calling 'run', while the stages already started keep running in the
+    pool (new ones start when the main thread stage is over). The start and end time of every stage is recorded in
+    'timeline'.
+
+    Example:
+        pipeline = Pipeline()
+        pipeline.add('download', download)
+        pipeline.add('mdt', make_mdt)
+        pipeline.add('inversion', inversion, deps = ['download', 'mdt'])
+        pipeline.run()
+    """
+
+    main_thread_resources = ('pyplot',)
+
+    def __init__(self, max_workers = 4, profiler = None):
+        self.max_workers = max_workers
+        self.profiler = profiler
+        self.stages = {}
+        self.results = {}
+        self.timeline = []
+        self.locks = {}
+
+    def add(self, name, func, deps = (), resources = ()):
+
+        """
+        Adds a stage to the pipeline.
+
+        Args:
+            name (str): Unique name of the stage.
+            func (callable): Function to run, without arguments.
+            deps (list, optional): Names of the stages that must be completed before this one starts. Default is none.
+            resources (list, optional): Names of resources used exclusively by this stage. Default is none.
+
+        Returns:
+            str: The name of the stage.
+        """
+
+        if name in self.stages:
+            raise ValueError('Stage '+name+' already defined')
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError('Stage '+name+' depends on unknown stage '+dep)
+        for resource in resources:
+            self.locks.setdefault(resource, threading.Lock())
+        self.stages[name] = dict(func = func, deps = list(deps), resources = sorted(resources))
+        return name
+
+    def on_main_thread(self, name):
+        return any(resource in self.main_thread_resources for resource in self.stages[name]['resources'])
+
+    def run_stage(self, name, t0):
+        stage = self.stages[name]
+        locks = [self.locks[resource] for resource in stage['resources']]
+        for lock in locks:
+            lock.acquire()
+        start = time.perf_counter()
+        try:
+            print('[pipeline] start '+name)
+            with self.profiler.stage(name) if self.profiler is not None else nullcontext():
+                return stage['func']()
+        finally:
+            end = time.perf_counter()
+            for lock in reversed(locks):
+                lock.release()
+            self.timeline.append(dict(stage = name, start = start-t0, end = end-t0, duration = end-start, thread = threading.current_thread().name))
+            print('[pipeline] end '+name+' ('+str(round(end-start, 1))+' s)')
+
+    def run(self):
+
+        """
+        Runs all the stages, honouring their dependencies.
+
+        Returns:
+            dict: The values returned by the stages, by name.
+
+        If a stage fails, no new stage is started, the running ones are waited for and the first error is raised.
+        """
+
+        t0 = time.perf_counter()
+        done = set()
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            while True:
+                main_stage = None
+                if error is None:
+                    for name, stage in self.stages.items():
+                        if name not in done and name not in running.values() and all(dep in done for dep in stage['deps']):
+                            if not self.on_main_thread(name):
+                                running[executor.submit(self.run_stage, name, t0)] = name
+                            elif main_stage is None:
+                                main_stage = name
+
+                # Main thread stages run here, one at a time, the running pool stages go on meanwhile
+                if main_stage is not None:
+                    try:
+                        self.results[main_stage] = self.run_stage(main_stage, t0)
+                        done.add(main_stage)
+                    except Exception as e:
+                        print('[pipeline] stage '+main_stage+' failed: '+repr(e))
+                        error = error or e
+                    continue
+
+                if not running:
+                    break
+                finished, pending = wait(list(running), return_when = FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        done.add(name)
+                    except Exception as e:
+                        print('[pipeline] stage '+name+' failed: '+repr(e))
+                        error = error or e
+
+        if error is not None:
+            raise error
+        return self.results
+
+    def report(self):
+
+        """
+        Prints the timeline of the stages (start, end and duration in seconds from the start of the run).
+
+        Returns:
+            list: The timeline, one dict per stage, sorted by start time.
+        """
+
+        timeline = sorted(self.timeline, key = lambda item: item['start'])
+        total = max([item['end'] for item in timeline] + [0])
+        print('{:<28}{:>10}{:>10}{:>10}  '.format('stage', 'start', 'end', 'duration'))
+        for item in timeline:
+            width = 40
+            a = int(width*item['start']/total) if total else 0
+            b = max(a+1, int(width*item['end']/total)) if total else 1
+            print('{stage:<28}{start:>10.1f}{end:>10.1f}{duration:>10.1f}  '.format(**item)+' '*a+'#'*(b-a))
+        return timeline
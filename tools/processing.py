@@ -5,6 +5,8 @@ import pyinterp.fill
 from pandas import to_datetime
 from datetime import timedelta
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Check MDT is ready
 def make_mdt(name_experiment, currdir, bbox, dataset_mdt = "mdt_hybrid_cnes_cls18_cmems2020_global.nc"):
@@ -33,7 +35,199 @@ def make_mdt(name_experiment, currdir, bbox, dataset_mdt = "mdt_hybrid_cnes_cls1
         mdt = ds.mdt
         mdt.to_netcdf(currdir+'/input_'+name_experiment+'/cnes_mdt_local.nc')
 
-def compute_filled_map(BC_data_path, save_to, bbox):
+def subset_alongtrack(input_dir, bbox, window = None, halo = 1., name_lon = 'longitude', name_lat = 'latitude', name_time = 'time',
+                      remove_originals = False):
+
+    """
+    Cuts the alongtrack (L3) files of a dataset folder to the experiment domain, right after their download.
+
+    Args:
+        input_dir (str): The folder holding the L3 NetCDF files of one dataset.
+        bbox (list): The bounding box coordinates [lon_min, lon_max, lat_min, lat_max].
+        window (tuple, optional): (first_time, last_time) datetimes. If given, only observations within this period are kept.
+            Default is None (all times).
+        halo (float, optional): Margin added around the bounding box, in degrees. Default is 1.
+        name_lon (str, optional): Name of the longitude variable. Default is 'longitude'.
+        name_lat (str, optional): Name of the latitude variable. Default is 'latitude'.
+        name_time (str, optional): Name of the time dimension along the tracks. Default is 'time'.
+        remove_originals (bool, optional): Write the subset in input_dir and remove the original files from it, so that MASSH
+            only reads the subset there. Only set it when the originals survive elsewhere, i.e. when they were downloaded
+            through a shared observation cache (cache_dir of download_nadirs_cmems). Without a cache, the incremental sync
+            restores unchanged files from the input folder of the previous run, and would download them all again. Default
+            is False: the subset is written in '<input_dir>_subset' and input_dir is left untouched.
+
+    Returns:
+        int: The number of observation points kept.
+
+    The function opens each file of the folder once, keeps only the points inside the bounding box (plus halo) and the time
+    window, and writes all of them in a single file '<dataset>_subset.nc'. Longitudes are compared modulo 360°. If no point
+    at all falls in the domain, nothing is written and the original files are kept.
+    """
+
+    dataset = os.path.basename(os.path.normpath(input_dir))
+    subset_name = dataset+'_subset.nc'
+    filenames = sorted(name for name in os.listdir(input_dir) if name.endswith('.nc') and name != subset_name)
+    if len(filenames) == 0:
+        return 0
+
+    width = (bbox[1]-bbox[0]) % 360 + 2*halo
+    subsets = []
+    for filename in filenames:
+        with xr.open_dataset(os.path.join(input_dir, filename)) as ds:
+            lon = ds[name_lon].values
+            lat = ds[name_lat].values
+            keep = ((lon-bbox[0]+halo) % 360 <= width) & (lat >= bbox[2]-halo) & (lat <= bbox[3]+halo)
+            if window is not None:
+                time = ds[name_time].values
+                keep &= (time >= np.datetime64(window[0])) & (time <= np.datetime64(window[1]))
+            if keep.any():
+                subsets.append(ds.isel({name_time: np.flatnonzero(keep)}).load())
+
+    if len(subsets) == 0:
+        print('[Warning] No observation of '+dataset+' within the domain, keeping original files.')
+        return 0
+
+    subset = xr.concat(subsets, dim = name_time, data_vars = 'minimal', coords = 'minimal', compat = 'override').sortby(name_time)
+    output_dir = input_dir if remove_originals else os.path.normpath(input_dir)+'_subset'
+    os.makedirs(output_dir, exist_ok = True)
+    subset.to_netcdf(os.path.join(output_dir, subset_name+'.tmp'), mode = 'w')
+    os.replace(os.path.join(output_dir, subset_name+'.tmp'), os.path.join(output_dir, subset_name))
+
+    if remove_originals:
+        for filename in filenames:
+            os.remove(os.path.join(input_dir, filename))
+
+    print(dataset+': '+str(subset.sizes[name_time])+' observations kept out of '+str(len(filenames))+' files')
+    return subset.sizes[name_time]
+
+def fill_gaps(adt, x_axis, y_axis, num_threads = 1):
+
+    """
+    Fills the undefined (NaN) values of a single map by Gauss-Seidel relaxation.
+
+    Args:
+        adt (numpy.ndarray): The map, with dimensions (latitude, longitude).
+        x_axis (pyinterp.Axis): The longitude axis.
+        y_axis (pyinterp.Axis): The latitude axis.
+        num_threads (int): The number of threads used by pyinterp for this map. Default is 1.
+
+    Returns:
+        numpy.ndarray: A (longitude, latitude) array with the filled map, as returned by pyinterp.
+    """
+
+    # pyinterp expects (x, y) grids : the transpose is a view, no copy is made here
+    has_converged, filled = pyinterp.fill.gauss_seidel(pyinterp.Grid2D(x_axis, y_axis, adt.T), num_threads = num_threads)
+    return filled
+
+def relax_fill(adt, first_guess = None, max_iterations = 2000, epsilon = 1e-4, relaxation = 1.6):
+
+    """
+    Fills the undefined (NaN) values of a single map by red-black successive over-relaxation, from a given first guess.
+
+    Args:
+        adt (numpy.ndarray): The map, with dimensions (latitude, longitude).
+        first_guess (numpy.ndarray, optional): Initial values of the undefined points, e.g. the filled map of a neighbouring
+            day. Default is None (zonal average, as in pyinterp).
+        max_iterations (int, optional): Maximum number of iterations. Default is 2000.
+        epsilon (float, optional): Convergence criterion on the largest update of an iteration. Default is 1e-4.
+        relaxation (float, optional): Over-relaxation factor, between 1 and 2. Default is 1.6.
+
+    Returns:
+        tuple: (has_converged, filled map with dimensions (latitude, longitude)).
+
+    It solves the same problem as pyinterp.fill.gauss_seidel (Laplace equation over the undefined points, defined points
+    as boundary conditions, Neumann conditions at the edges of the domain), but accepts any first guess: starting from
+    the solution of a nearby day, only a few iterations are needed.
+    """
+
+    mask = np.isnan(adt)
+    filled = np.array(adt, dtype = float)
+    if not mask.any():
+        return True, filled
+
+    if first_guess is None:
+        with np.errstate(all = 'ignore'):
+            zonal = np.nanmean(adt, axis = 1, keepdims = True)
+        zonal = np.where(np.isnan(zonal), np.nanmean(adt) if (~mask).any() else 0., zonal)
+        filled[mask] = np.broadcast_to(zonal, adt.shape)[mask]
+    else:
+        filled[mask] = first_guess[mask]
+
+    i, j = np.indices(adt.shape)
+    colours = [mask & ((i+j)%2 == 0), mask & ((i+j)%2 == 1)]
+
+    for iteration in range(max_iterations):
+        max_update = 0.
+        for colour in colours:
+            padded = np.pad(filled, 1, mode = 'edge') # Neumann condition at boundaries
+            average = (padded[:-2,1:-1]+padded[2:,1:-1]+padded[1:-1,:-2]+padded[1:-1,2:])/4
+            update = relaxation*(average[colour]-filled[colour])
+            filled[colour] += update
+            if update.size:
+                max_update = max(max_update, np.abs(update).max())
+        if max_update < epsilon:
+            return True, filled
+    return False, filled
+
+def fill_cache_paths(cache_dir, source, date, bbox):
+
+    """
+    Returns the files of the filled maps cache for a time step.
+
+    Args:
+        cache_dir (str): Folder of the cache.
+        source (str): Name of the L4 file holding the time step.
+        date (numpy.datetime64): Date of the time step.
+        bbox (list): The bounding box coordinates [lon_min, lon_max, lat_min, lat_max].
+
+    Returns:
+        tuple: (path of the converged map for this exact source file, date and bbox; path of the latest converged map for
+            this date and bbox, whatever its source file, used as first guess).
+    """
+
+    import hashlib
+    day = str(np.datetime64(date, 's'))
+    domain = ','.join(str(float(b)) for b in bbox)
+    exact = hashlib.md5((str(source)+'|'+day+'|'+domain).encode()).hexdigest()
+    latest = hashlib.md5((day+'|'+domain).encode()).hexdigest()
+    return os.path.join(cache_dir, exact+'.npy'), os.path.join(cache_dir, 'latest_'+latest+'.npy')
+
+def load_cached_map(path, shape):
+
+    """ Map of the filled maps cache at path, or None if it is missing, unreadable (e.g. truncated) or of another shape. """
+
+    try:
+        cached = np.load(path)
+    except (OSError, ValueError, EOFError):
+        return None
+    return cached if cached.shape == shape else None
+
+def save_cached_map(path, filled):
+
+    """
+    Saves a map to the filled maps cache atomically: it is written to a temporary file of its own, then renamed, so that
+    an interrupted run or another run writing the same key (e.g. the prefetch of the next date) never leaves a partial file.
+    """
+
+    tmp = path+'.'+str(os.getpid())+'_'+str(threading.get_ident())+'.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, filled)
+    os.replace(tmp, path)
+
+def time_sources(BC_data_path):
+
+    """ Maps each time step of the files matching BC_data_path to the name of the file holding it. """
+
+    import glob
+    sources = {}
+    for path in sorted(glob.glob(BC_data_path)):
+        with xr.open_dataset(path) as ds:
+            for time in ds.time.values:
+                sources[time] = os.path.basename(path)
+    return sources
+
+def compute_filled_map(BC_data_path, save_to, bbox, n_workers = None, num_threads = 1, warm_start = False, cache_dir = None, stream = False, chunk_size = None,
+                       dtype = np.float64, method = 'gauss_seidel'):
 
     """
     Computes and saves the filled map based on the provided boundary condition data.
@@ -42,6 +236,21 @@ def compute_filled_map(BC_data_path, save_to, bbox):
         BC_data_path (str): The path to the boundary condition data.
         save_to (str): The path to save the filled map.
         bbox (list): The bounding box coordinates [lon_min, lon_max, lat_min, lat_max].
+        n_workers (int, optional): The number of time steps filled in parallel. Default is None (number of CPUs).
+        num_threads (int, optional): The number of pyinterp threads used for each time step. Default is 1.
+        warm_start (bool, optional): Start the relaxation of each time step from the filled map of the previous run for the
+            same date (requires cache_dir), or else from the filled map of the previous time step. Default is False.
+        cache_dir (str, optional): Folder where converged time steps are kept, keyed by (source file, date, bbox). Time steps
+            already in the cache are not solved again. Default is None (no cache).
+        stream (bool, optional): Bounded memory mode: the time steps are read, filled and written chunk_size at a time
+            into a preallocated 'adt_full' variable of the output file. Default is False (whole cube in memory).
+        chunk_size (int, optional): Number of time steps per chunk in stream mode. Default is None (n_workers, or the
+            number of CPUs).
+        dtype (numpy.dtype, optional): Type of the filled maps 'adt_full', e.g. np.float32 to halve the memory and the size
+            of the output. Each map is still solved in double precision. Default is np.float64.
+        method (str, optional): 'gauss_seidel' (iterative relaxation, with pyinterp or 'relax_fill' in warm start mode) or
+            'direct' (sparse direct solution of the same problem with 'tools.spectral.poisson_fill', faster for large gaps,
+            warm_start is then useless). Default is 'gauss_seidel'.
 
     Returns:
         None
@@ -49,43 +258,125 @@ def compute_filled_map(BC_data_path, save_to, bbox):
     The function opens the boundary condition data and subsets it to the specified bounding box. It then computes the
     filled map using the Gaussian Seidel method and saves the result to the specified location. The point of this operation
     is that the filled map can be masked by a different resolution land mask without having ill-valued pixels at coastlines.
+
+    The time steps are independent: they are spread over a pool of n_workers threads (pyinterp releases the GIL) and each
+    filled map is written directly into a preallocated (time, latitude, longitude) array. In warm start mode, the
+    time steps are solved one after the other with 'relax_fill', seeded with the closest known solution.
+
+    In stream mode, peak memory is set by chunk_size rather than by the length of the time window: the subset of the
+    input is first written lazily (file by file) to the output, then 'adt_full' is added to it chunk by chunk.
     """
 
+    if method not in ['gauss_seidel', 'direct']:
+        raise ValueError('Unknown filling method '+method)
+
     ds = xr.open_mfdataset(BC_data_path)
     ds = ds.sel(longitude = slice(bbox[0],bbox[1]), latitude = slice(bbox[2],bbox[3]))
 
     longitude = ds.longitude.values
     latitude = ds.latitude.values
+    times = ds.time.values
 
     x_axis = pyinterp.Axis(longitude)
     y_axis = pyinterp.Axis(latitude)
 
-    adt_filled = np.zeros((len(ds.time), len(longitude), len(latitude)))
-    adt_filled_upright = np.zeros((len(ds.time), len(latitude), len(longitude)))
-
-    for t in np.arange(len(ds.time)):
-        has_converged, adt_filled[t] = pyinterp.fill.gauss_seidel(pyinterp.Grid2D(x_axis, y_axis, ds.adt[t].values.T)) # values are transposed you have to T them back
-        adt_filled_upright[t] = adt_filled[t].T
-
-    ds['adt_full'] = (['time', 'latitude', 'longitude'], adt_filled_upright)
-
-    ds.to_netcdf(save_to, mode = 'w')
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok = True)
+        sources = time_sources(BC_data_path)
+
+    def fill_time_step(t, adt_t, first_guess):
+        # Reuse the time steps already solved by a previous run
+        if cache_dir is not None:
+            exact, latest = fill_cache_paths(cache_dir, sources.get(times[t]), times[t], bbox)
+            cached = load_cached_map(exact, adt_t.shape)
+            if cached is not None:
+                return cached, True
+            if warm_start:
+                cached = load_cached_map(latest, adt_t.shape)
+                if cached is not None:
+                    first_guess = cached
+
+        if method == 'direct':
+            from tools.spectral import poisson_fill
+            filled = poisson_fill(adt_t)
+        elif warm_start and first_guess is not None:
+            has_converged, filled = relax_fill(adt_t, first_guess)
+        else:
+            filled = fill_gaps(adt_t, x_axis, y_axis, num_threads).T # values are transposed you have to T them back
+
+        if cache_dir is not None:
+            save_cached_map(exact, filled)
+            save_cached_map(latest, filled)
+        return filled, False
+
+    if stream:
+        import netCDF4
+        ds.to_netcdf(save_to, mode = 'w')
+        nc = netCDF4.Dataset(save_to, 'a')
+        adt_filled = nc.createVariable('adt_full', np.dtype(dtype), ('time', 'latitude', 'longitude'))
+        chunk_size = chunk_size or n_workers or os.cpu_count()
+    else:
+        adt_filled = np.empty((len(times), len(latitude), len(longitude)), dtype = dtype)
+        chunk_size = len(times)
+
+    n_cached = 0
+    previous = None
+    with ThreadPoolExecutor(max_workers = n_workers or os.cpu_count()) as executor:
+        for start in range(0, len(times), chunk_size):
+            steps = range(start, min(start+chunk_size, len(times)))
+            adt = ds.adt[steps.start:steps.stop].values
+            # Filled in place in memory mode, through a chunk buffer in stream mode
+            filled = np.empty(adt.shape, dtype = dtype) if stream else adt_filled[steps.start:steps.stop]
+
+            if warm_start:
+                # Each time step is seeded with the previous one
+                for i, t in enumerate(steps):
+                    filled[i], cached = fill_time_step(t, adt[i], previous)
+                    previous = filled[i]
+                    n_cached += cached
+            else:
+                for i, (filled_t, cached) in enumerate(executor.map(lambda i: fill_time_step(steps[i], adt[i], None), range(len(steps)))):
+                    filled[i] = filled_t
+                    n_cached += cached
+
+            if stream:
+                adt_filled[steps.start:steps.stop] = filled
+
+    if cache_dir is not None:
+        print('Filled maps: '+str(n_cached)+' time steps from cache, '+str(len(times)-n_cached)+' solved')
+
+    if stream:
+        nc.close()
+    else:
+        ds['adt_full'] = (['time', 'latitude', 'longitude'], adt_filled)
+        ds.to_netcdf(save_to, mode = 'w')
 
 
-def compute_u_v_rv(ssh_map):
+def compute_u_v_rv(ssh_map, metrics_dir = None, dtype = np.float64, engine = 'finite_difference'):
         
     """
     Computes U, V, and RV (Relative Vorticity) based on the given sea surface height map.
 
     Args:
-        ssh_map (xarray.Dataset): Sea surface height map containing the 'ssh' variable with dimensions (time, lat, lon).
+        ssh_map (xarray.Dataset): Sea surface height map containing the 'ssh' variable with dimensions (time, lat, lon), and
+            possibly other leading dimensions (e.g. member).
+        metrics_dir (str, optional): Folder where the grid metrics are stored between runs (see tools.grid.GridMetrics).
+            Default is None (metrics only kept in memory).
+        dtype (numpy.dtype, optional): Working type of the SSH and of the computed fields. Default is np.float64.
+        engine (str, optional): 'finite_difference' (centred differences, 'tools.vars.h2uvrv') or 'spectral' (FFT
+            derivatives, 'tools.spectral.spectral_uvrv', more accurate on smooth fields without undefined points: it raises a
+            ValueError on NaN, e.g. land). Default is 'finite_difference'.
 
     Returns:
         xarray.Dataset: The input dataset with additional variables 'u', 'v', and 'xi_norm' computed based on the SSH map.
 
     The function computes the U (eastward velocity), V (northward velocity), and RV (Relative Vorticity) fields using the
-    sea surface height (SSH) map. It calculates the necessary physical parameters, such as dy, dx, and f, based on the
-    geographical grid of the SSH map. Then, it iterates over each time step in the SSH map to compute the U, V, and RV fields.
+    sea surface height (SSH) map. The necessary physical parameters, such as dy, dx, and f, are taken from the metrics of
+    the geographical grid of the SSH map, which are only computed the first time a grid is seen. Then, it computes the U,
+    V, and RV fields for all time steps at once with the fused kernel 'tools.vars.h2uvrv' (compiled with numba when available).
+
+    If the SSH is a dask array, the computation is lazy: the kernel is applied chunk by chunk on time, in parallel when the
+    result is computed. Chunks must span the whole (lat, lon) grid, as the operators need the neighbouring points.
 
     The computed U, V, and RV fields are added as additional variables 'u', 'v', and 'xi_norm' to the input SSH map dataset,
     respectively. The resulting dataset is returned.
@@ -94,49 +385,264 @@ def compute_u_v_rv(ssh_map):
         - The 'ssh_map' dataset must have the 'ssh' variable with dimensions (time, lat, lon).
     """
 
-    # A few physical parameters for computations
-    g=9.81 # m/s2
-    earth_rad=6.371e6 # 6371km
-    earth_w=2*np.pi/86400 # rad/s
+    from tools.grid import GridMetrics
+    from tools.vars import h2uvrv
 
-    # Create the dy, dx and f grids based on physical parameters
-    lon=ssh_map.lon.values
-    lat=ssh_map.lat.values
-    x, y = np.meshgrid(lon, lat)
+    if engine not in ['finite_difference', 'spectral']:
+        raise ValueError('Unknown derivative engine '+engine)
 
-    dy = np.ones(y.shape)
-    dx = np.ones(x.shape)
+    # dy, dx, f and the stencil coefficients of the grid
+    metrics = GridMetrics.from_axes(ssh_map.lon.values, ssh_map.lat.values, cache_dir = metrics_dir)
 
-    dy[1:-1,:]=earth_rad*2*np.pi/360*(y[1:-1,:]-y[0:-2,:])
-    dx[:,1:-1]=earth_rad*2*np.pi/360*(x[:,1:-1]-x[:,0:-2])*np.cos(((y[:,1:-1]+y[:,0:-2])/2)*np.pi/180)
+    # U, V & RV computation, on the whole cube or on each time chunk of a dask array. Chunks are already processed in
+    # parallel by dask, so they do not use the parallel numba kernel (concurrent launches from several threads).
+    backend = 'numpy' if ssh_map.ssh.chunks is not None else 'auto'
 
-    # Neumann condition at boundaries
-    dy[0,:]=dy[1,:]
-    dy[-1,:]=dy[-2,:]
-    dx[:,0]=dx[:,1]
-    dx[:,-1]=dx[:,-2]
+    def uvrv_block(h):
+        h = np.ascontiguousarray(h, dtype = dtype)
+        out = tuple(np.empty(h.shape, dtype = dtype) for _ in range(3))
+        if engine == 'spectral':
+            from tools.spectral import spectral_uvrv
+            return spectral_uvrv(h, metrics, out = out)
+        return h2uvrv(h, metrics = metrics, out = out, backend = backend)
 
-    f=2*earth_w*np.sin(y*np.pi/180)
+    u, v, xi_norm = xr.apply_ufunc(uvrv_block, ssh_map.ssh.transpose(..., 'lat', 'lon'),
+                                   input_core_dims = [['lat', 'lon']], output_core_dims = [['lat', 'lon']]*3,
+                                   dask = 'parallelized', output_dtypes = [np.dtype(dtype)]*3)
 
-    # U, V & RV computation
-    u=np.zeros((len(ssh_map.time), len(lat), len(lon)))
-    v=np.zeros((len(ssh_map.time), len(lat), len(lon)))
-    xi_norm=np.zeros((len(ssh_map.time), len(lat), len(lon)))
+    ssh_map['u'] = u.variable
+    ssh_map['v'] = v.variable
+    ssh_map['xi_norm'] = xi_norm.variable
 
-    from tools.vars import h2uv, h2rv
+    return ssh_map
 
-    for t in np.arange(len(ssh_map.time)):
-        (u[t, :, :], v[t, :, :]) = h2uv(ssh = ssh_map.ssh[t, :, :], dy = dy, dx = dx, g = g, f = f)
-        xi_norm[t, :, :] = h2rv(ssh = ssh_map.ssh[t, :, :], dy = dy, dx = dx, g = g, f = f)
 
-    ssh_map['u'] = (['time', 'lat', 'lon'],  u)
-    ssh_map['v'] = (['time', 'lat', 'lon'],  v)
-    ssh_map['xi_norm'] = (['time', 'lat', 'lon'],  xi_norm)
+# Fields derived from the SSH maps in nc_processing, by name. 'func' adds the fields to a dataset (called as
+# func(dataset, metrics_dir = ..., dtype = ...)) and 'linear' tells whether they are linear in the SSH. Linear derivations commute
+# with the time averaging, so nc_processing computes them on the binned maps, i.e. on far fewer time steps; non-linear
+# ones (e.g. kinetic energy) are computed on every output state, before averaging.
+DERIVATIONS = {
+    'u_v_rv': dict(func = compute_u_v_rv, linear = True),
+}
 
-    return ssh_map
+def register_derivation(name, func, linear):
 
+    """
+    Adds a derived field to the outputs of nc_processing.
 
-def nc_processing(name_experiment, today, numdays = 6, frequency_hours = 24):
+    Args:
+        name (str): Name of the derivation (an existing one is replaced).
+        func (callable): Function taking the SSH dataset and 'metrics_dir' and 'dtype' keywords, and returning it with the new
+            variables.
+        linear (bool): Whether the fields are linear in the SSH (then computed after the time averaging).
+
+    Returns:
+        None
+    """
+
+    DERIVATIONS[name] = dict(func = func, linear = linear)
+
+
+def time_bins(times, today, numdays = 6, frequency_hours = 24):
+
+    """
+    Assigns the output states of nc_processing to their time averaging bins.
+
+    Args:
+        times (1D datetime64 array): Times of the states.
+        today (datetime.date): The current date (end of the last bin).
+        numdays (int, optional): The number of days covered by the bins. Default is 6.
+        frequency_hours (int, optional): Length of the bins in hours. Default is 24.
+
+    Returns:
+        tuple: (bin_index, labels) with the index of the bin of every state (-1 if it falls in none) and the time label
+            of every bin.
+
+    With `frequency_hours` = 24, bins are the calendar days of the states, labeled by their first instant. Otherwise, bins
+    are the right-closed intervals of `frequency_hours` hours between today-numdays and today, labeled by their midpoints.
+    """
+
+    times = np.asarray(times, dtype = 'datetime64[ns]')
+
+    if frequency_hours == 24:
+        labels, bin_index = np.unique(times.astype('datetime64[D]'), return_inverse = True)
+        return bin_index.ravel(), labels.astype('datetime64[ns]')
+
+    from pandas import date_range
+    edges = date_range(start=to_datetime(today-timedelta(days=numdays)), end=today, freq=timedelta(hours=frequency_hours)).values
+    bin_index = np.searchsorted(edges, times, side='left') - 1
+    bin_index[bin_index >= len(edges)-1] = -1
+    return bin_index, edges[:-1] + np.timedelta64(frequency_hours*3600//2, 's')
+
+def bin_means(ds, bin_index, labels):
+
+    """
+    Averages a dataset over time bins, in a single pass.
+
+    Args:
+        ds (xarray.Dataset): Dataset with a 'time' dimension, with numpy or dask variables.
+        bin_index (1D array): Bin of every time step, -1 for the ones to leave out (see time_bins).
+        labels (1D array): Time label of every bin.
+
+    Returns:
+        xarray.Dataset: The mean of the variables over each bin, along a new 'time' coordinate holding the labels. Bins
+            without any time step (e.g. a gap in the outputs) are left out, so that no empty product is written. Variables
+            without a time dimension are left unchanged.
+
+    Time steps are sorted by bin once, so that every bin is a contiguous segment. The means of numpy variables are then
+    computed with one segment sum (np.add.reduceat) over all the bins, and those of dask variables lazily, one slice per
+    bin. Like xarray means, NaNs are skipped.
+    """
+
+    bin_index = np.asarray(bin_index)
+    keep = np.flatnonzero(bin_index >= 0)
+    if len(keep) == 0:
+        raise ValueError('No time step falls in the averaging bins')
+    order = keep[np.argsort(bin_index[keep], kind='stable')]
+    sorted_bins = bin_index[order]
+    starts = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    filled = labels[sorted_bins[starts]]
+
+    if not np.array_equal(order, np.arange(ds.sizes['time'])):
+        ds = ds.isel(time=order)
+
+    means = {}
+    for name, var in ds.data_vars.items():
+        if 'time' not in var.dims:
+            means[name] = var
+        elif var.chunks is not None:
+            means[name] = xr.concat([var.isel(time=slice(a, b)).mean('time') for a, b in zip(starts, ends)], dim='time').transpose(*var.dims)
+        else:
+            axis = var.get_axis_num('time')
+            data = np.asarray(var.values, dtype = np.result_type(var.dtype, np.float32))
+            missing = np.isnan(data)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.add.reduceat(np.where(missing, 0, data), starts, axis=axis)/np.add.reduceat(~missing, starts, axis=axis)
+            means[name] = (var.dims, mean, var.attrs)
+
+    coords = {name: coord for name, coord in ds.coords.items() if 'time' not in coord.dims}
+    return xr.Dataset(means, coords=dict(coords, time=filled), attrs=ds.attrs)
+
+
+# Names of the variables in the products read by LAMTA (full_timeseries), from those of the NRT products
+LAMTA_NAMES = {'lon': 'longitude', 'lat': 'latitude', 'u': 'ugos', 'v': 'vgos'}
+
+# Lock of the netCDF files read and written concurrently by nc_processing (pass it to open_mfdataset as 'lock'). The
+# netCDF/HDF5 libraries are not thread safe and xarray does not lock every library call of a write, so a file must not
+# be written while another thread reads or writes one.
+NETCDF_LOCK = threading.Lock()
+
+def product_encoding(ds, complevel = None, chunksizes = None, pack_int16 = False):
+
+    """
+    NetCDF encoding of the variables of an output product.
+
+    Args:
+        ds (xarray.Dataset): The product.
+        complevel (int, optional): zlib compression level (1-9). Default is None (no compression).
+        chunksizes (dict, optional): NetCDF chunk size by dimension name, e.g. {'time': 1, 'lat': 256, 'lon': 256}.
+            Dimensions left out are not split. Default is None (netCDF default).
+        pack_int16 (bool, optional): Store the variables as 16-bit integers with CF 'scale_factor' and 'add_offset', chosen
+            from the range of each variable in ds (which must be loaded). Default is False.
+
+    Returns:
+        dict: The encoding, to pass to 'to_netcdf'.
+
+    With int16 packing, the quantization step is the range of the variable divided by 65534, e.g. 0.03 mm for an SSH
+    range of 2 m; -32768 is kept as fill value.
+    """
+
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = {}
+        if complevel:
+            encoding[name].update(zlib = True, complevel = complevel)
+        if chunksizes is not None:
+            encoding[name]['chunksizes'] = tuple(min(chunksizes.get(dim, size), size) for dim, size in var.sizes.items())
+        if pack_int16:
+            values = var.values
+            defined = np.isfinite(values)
+            vmin, vmax = (values[defined].min(), values[defined].max()) if defined.any() else (0., 0.)
+            scale_factor = (vmax-vmin)/(2**16-2) if vmax > vmin else 1.
+            encoding[name].update(dtype = 'int16', scale_factor = var.dtype.type(scale_factor), add_offset = var.dtype.type((vmax+vmin)/2), _FillValue = np.int16(-2**15))
+    return encoding
+
+def write_product(ds, nrt_path, lamta_path = None, complevel = None, chunksizes = None, pack_int16 = False):
+
+    """
+    Writes a loaded product in the NRT layout and, optionally, in the LAMTA layout (renamed view of the same arrays,
+    see LAMTA_NAMES), under NETCDF_LOCK. The other arguments are those of product_encoding.
+    """
+
+    encoding = product_encoding(ds, complevel, chunksizes, pack_int16)
+    with NETCDF_LOCK:
+        ds.to_netcdf(nrt_path, mode = 'w', encoding = encoding)
+        if lamta_path is not None:
+            ds.rename(LAMTA_NAMES).to_netcdf(lamta_path, mode = 'w', encoding = {LAMTA_NAMES.get(name, name): value for name, value in encoding.items()})
+
+def write_products(binned, paths, n_workers = None, complevel = None, chunksizes = None, pack_int16 = False):
+
+    """
+    Writes the time steps of a dataset in the NRT and LAMTA layouts, in parallel.
+
+    Args:
+        binned (xarray.Dataset): The binned maps (numpy or dask variables).
+        paths (list): (NRT path, LAMTA path) of every time step.
+        n_workers (int, optional): Number of time steps written at the same time. Default is None (ThreadPoolExecutor default).
+        complevel (int, optional): zlib compression level, see product_encoding. Default is None.
+        chunksizes (dict, optional): NetCDF chunk sizes in the NRT dimension names, see product_encoding. Default is None.
+        pack_int16 (bool, optional): Pack the variables as int16, see product_encoding. Default is False.
+
+    Returns:
+        None
+
+    Each time step is computed once into memory and both files are written from that buffer, the LAMTA one through a
+    renamed view (LAMTA_NAMES) of the same arrays. Time steps are computed in parallel, but files are written one at a
+    time, under NETCDF_LOCK: dask variables read from netCDF files must have been opened with that lock.
+    """
+
+    def write(i):
+        ds = binned.isel(time=[i]).compute(scheduler = 'synchronous')
+        write_product(ds, paths[i][0], paths[i][1], complevel, chunksizes, pack_int16)
+
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        list(executor.map(write, range(binned.sizes['time'])))
+
+
+def product_paths(name_experiment, today, times, frequency_hours = 24, prefix = 'NRT_BFN_'):
+
+    """
+    Paths of the products of an experiment, creating their folders.
+
+    Args:
+        name_experiment (str): The name of the experiment.
+        today (datetime.date): The current date.
+        times (1D datetime64 array): Time labels of the products.
+        frequency_hours (int, optional): Length of the time bins in hours (hourly file names if not 24). Default is 24.
+        prefix (str, optional): Prefix of the NRT file names. Default is 'NRT_BFN_'.
+
+    Returns:
+        list: (NRT path, LAMTA path) of every time label.
+    """
+
+    os.makedirs('./maps_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/', exist_ok = True)
+    os.makedirs('./maps_'+name_experiment+'/full_timeseries/', exist_ok = True)
+
+    if frequency_hours == 24:
+        format = '%Y%m%d'
+    else:
+        format = '%Y%m%d-%H'
+
+    paths = []
+    for d in times:
+        date = to_datetime(d)
+        paths.append(('./maps_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/'+prefix+date.strftime(format)+'.nc', # Store in daily folder
+                      './maps_'+name_experiment+'/full_timeseries/BFN_lamta_'+date.strftime(format)+'.nc')) # Store in global product for diagnostics
+    return paths
+
+def nc_processing(name_experiment, today, numdays = 6, frequency_hours = 24, chunk_time = 8, n_workers = None, derive_after_binning = True,
+                  complevel = None, chunksizes = None, store_timeseries = True, dtype = np.float64, pack_int16 = False):
 
     """
     Performs netCDF processing for the given experiment and time period.
@@ -146,6 +652,18 @@ def nc_processing(name_experiment, today, numdays = 6, frequency_hours = 24):
         today (datetime.date): The current date.
         numdays (int, optional): The number of days to consider for processing. Default is 6.
         frequency_hours (int, optional): The frequency in hours for time averaging. Default is 24.
+        chunk_time (int, optional): Number of output states per dask chunk. Default is 8.
+        n_workers (int, optional): Number of bins computed and written at the same time. Default is None (ThreadPoolExecutor default).
+        derive_after_binning (bool, optional): Compute the linear derived fields (see DERIVATIONS) on the binned maps rather
+            than on every output state. Same result for much less work. Default is True.
+        complevel (int, optional): zlib compression level of the output files. Default is None (no compression).
+        chunksizes (dict, optional): NetCDF chunk sizes of the output files by dimension name. Default is None.
+        store_timeseries (bool, optional): Also add the binned maps to the consolidated time series store
+            'maps_<name_experiment>/full_timeseries.zarr' (see tools.timeseries), in the LAMTA layout. Default is True.
+        dtype (numpy.dtype, optional): Working type of the processing and of the products, e.g. np.float32 to halve memory
+            and file sizes. Default is np.float64.
+        pack_int16 (bool, optional): Pack the variables of the output files as int16 with CF scale_factor/add_offset.
+            Default is False.
 
     Returns:
         None
@@ -157,45 +675,120 @@ def nc_processing(name_experiment, today, numdays = 6, frequency_hours = 24):
     If `frequency_hours` is set to 24 (default), the function calculates the daily mean SSH by grouping the data
     by day and taking the mean. If `frequency_hours` is set to a different value, the function manually defines time
     bins of the specified frequency and calculates the mean SSH within each bin. The resulting time bins are labeled
-    with the midpoints of each bin.
+    with the midpoints of each bin. Bins are computed once for all states (see time_bins and bin_means), and every
+    output file is then a slice of the binned dataset.
+
+    The processing is out-of-core: the output states are read lazily with dask in chunks of `chunk_time` time steps
+    (each spanning the whole grid), and derivatives and binned means are only computed when the files are written,
+    `n_workers` bins at a time (see write_products). Only those bins are in memory, whatever the length of the run.
     """
     
 
     # Load the interest period and make binned averages
-    bfn_output = xr.open_mfdataset('./output_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/*.nc', concat_dim='time', combine='nested')
-    interest_period = bfn_output.where(bfn_output.time >= to_datetime(today-timedelta(days=numdays)), drop =True)
+    bfn_output = xr.open_mfdataset('./output_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/*.nc', concat_dim='time', combine='nested', parallel=True, lock=NETCDF_LOCK)
+    interest_period = bfn_output.isel(time=np.flatnonzero((bfn_output.time >= to_datetime(today-timedelta(days=numdays))).values))
+    interest_period = interest_period.chunk({'time': chunk_time, 'lat': -1, 'lon': -1}).astype(dtype)
 
-    interest_period = compute_u_v_rv(interest_period)
+    # Derived fields which do not commute with the time averaging
+    metrics_dir = './input_'+name_experiment
+    for derivation in DERIVATIONS.values():
+        if not (derivation['linear'] and derive_after_binning):
+            interest_period = derivation['func'](interest_period, metrics_dir = metrics_dir, dtype = dtype)
 
-    if frequency_hours == 24:
-        interest_period = interest_period.assign(time=to_datetime(interest_period.time.dt.date))
-        binned_ssh = interest_period.groupby("time").mean("time")
-    else:
-        from pandas import date_range
-        #Manually define the bins we want to use for time averaging
-        time_averaging_bins = date_range(start=to_datetime(today-timedelta(days=numdays)), end=today, freq=timedelta(hours=frequency_hours))
-        
-        #Group our DataArray by these bins
-        time_midpoints = date_range(start=to_datetime(today-timedelta(days=numdays))+timedelta(hours=frequency_hours)/2, end=today, freq=timedelta(hours=frequency_hours))
-        binned_ssh = interest_period.groupby_bins(group='time', bins=time_averaging_bins, labels=time_midpoints).mean('time')
-        binned_ssh = binned_ssh.rename({'time_bins': 'time'})
+    # Binned averages, in a single pass over the states
+    bin_index, labels = time_bins(interest_period.time.values, today, numdays, frequency_hours)
+    binned_ssh = bin_means(interest_period, bin_index, labels)
 
+    # Linear derived fields, from the binned SSH
+    for derivation in DERIVATIONS.values():
+        if derivation['linear'] and derive_after_binning:
+            binned_ssh = derivation['func'](binned_ssh, metrics_dir = metrics_dir, dtype = dtype)
 
     # Save final netcdf files - this can be adapted depending on the needs of the receiver (variable names, how many files, etc.)
-    os.makedirs('./maps_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/', exist_ok = True)
-    os.makedirs('./maps_'+name_experiment+'/full_timeseries/', exist_ok = True)
+    paths = product_paths(name_experiment, today, binned_ssh.time.values, frequency_hours)
+    write_products(binned_ssh, paths, n_workers = n_workers, complevel = complevel, chunksizes = chunksizes, pack_int16 = pack_int16)
+    bfn_output.close()
 
-    if frequency_hours == 24:
-        format = '%Y%m%d'
-    else:
-        format = '%Y%m%d-%H'
-        
-    for d in binned_ssh.time.values:
-        date = to_datetime(d)
-        ds=binned_ssh.where(binned_ssh.time == d, drop=True)
-        ds.to_netcdf('./maps_'+name_experiment+'/'+today.strftime('%Y%m%d')+'/NRT_BFN_'+date.strftime(format)+'.nc', mode = 'w') # Store in daily folder
-        ds_renamed = ds.rename({'lon': 'longitude','lat': 'latitude', 'u': 'ugos', 'v': 'vgos'})
-        ds_renamed.to_netcdf('./maps_'+name_experiment+'/full_timeseries/BFN_lamta_'+date.strftime(format)+'.nc', mode = 'w') # Store in global product for diagnostics
+    # Update the time series store from the files just written, overwriting the reprocessed dates
+    if store_timeseries:
+        from tools.timeseries import append_to_store
+        with xr.open_mfdataset([lamta_path for nrt_path, lamta_path in paths], concat_dim='time', combine='nested') as written:
+            append_to_store('./maps_'+name_experiment+'/full_timeseries.zarr', written)
+
+
+def nc_processing_ensemble(name_ensemble, members, today, numdays = 6, frequency_hours = 24, chunk_time = 8, n_workers = None,
+                           derive_after_binning = True, complevel = None, chunksizes = None, store_timeseries = True,
+                           dtype = np.float64, pack_int16 = False):
+
+    """
+    Performs the netCDF processing of an ensemble of experiments (e.g. sensitivity runs with different nudging_params_ssh,
+    c0 or window_size) in a single pass, and computes the ensemble mean and spread.
+
+    Args:
+        name_ensemble (str): Name under which the ensemble products are saved ('maps_<name_ensemble>').
+        members (list): The names of the experiments of the ensemble (at least two), with the same grid and output times.
+        today (datetime.date): The current date.
+        The other arguments are those of nc_processing.
+
+    Returns:
+        None
+
+    The outputs of all members are opened at once and stacked along a 'member' dimension, so that the derived fields and
+    the binned averages of nc_processing are computed for all members together: every dask chunk holds `chunk_time` time
+    steps of all members, and a single graph reads each output file once. Each binned time step is computed once, for all
+    members, and every file is written from that buffer, `n_workers` time steps at a time:
+        - the products of each member, as written by nc_processing for that experiment ('maps_<member>'),
+        - the ensemble mean, in the same layouts ('maps_<name_ensemble>'), so that the diagnostics and LAMTA can be run on
+          it as on an experiment,
+        - the ensemble spread (standard deviation across members), as 'maps_<name_ensemble>/<today>/NRT_BFN_spread_*.nc'.
+    Members and mean are also added to their time series stores if `store_timeseries` is True.
+    """
+
+    if len(members) < 2:
+        raise ValueError('An ensemble needs at least two members')
+
+    # Load the interest period of all members, stacked along 'member'. Grids and output times must be identical.
+    outputs = [xr.open_mfdataset('./output_'+member+'/'+today.strftime('%Y%m%d')+'/*.nc', concat_dim='time', combine='nested', parallel=True, lock=NETCDF_LOCK) for member in members]
+    bfn_output = xr.concat(outputs, dim='member', join='exact').assign_coords(member = list(members))
+    interest_period = bfn_output.isel(time=np.flatnonzero((bfn_output.time >= to_datetime(today-timedelta(days=numdays))).values))
+    interest_period = interest_period.chunk({'member': -1, 'time': chunk_time, 'lat': -1, 'lon': -1}).astype(dtype)
+
+    # Derived fields and binned averages, as in nc_processing, for all members at once
+    metrics_dir = './input_'+members[0]
+    for derivation in DERIVATIONS.values():
+        if not (derivation['linear'] and derive_after_binning):
+            interest_period = derivation['func'](interest_period, metrics_dir = metrics_dir, dtype = dtype)
+
+    bin_index, labels = time_bins(interest_period.time.values, today, numdays, frequency_hours)
+    binned_ssh = bin_means(interest_period, bin_index, labels)
+
+    for derivation in DERIVATIONS.values():
+        if derivation['linear'] and derive_after_binning:
+            binned_ssh = derivation['func'](binned_ssh, metrics_dir = metrics_dir, dtype = dtype)
+
+    times = binned_ssh.time.values
+    paths = {member: product_paths(member, today, times, frequency_hours) for member in members}
+    mean_paths = product_paths(name_ensemble, today, times, frequency_hours)
+    spread_paths = product_paths(name_ensemble, today, times, frequency_hours, prefix = 'NRT_BFN_spread_')
+
+    def write(i):
+        ds = binned_ssh.isel(time=[i]).compute(scheduler = 'synchronous')
+        for member in members:
+            write_product(ds.sel(member=member, drop=True), *paths[member][i], complevel, chunksizes, pack_int16)
+        attrs = dict(ds.attrs, ensemble_members = ' '.join(members))
+        write_product(ds.mean('member', keep_attrs = True).assign_attrs(attrs), *mean_paths[i], complevel, chunksizes, pack_int16)
+        write_product(ds.std('member', ddof = 1, keep_attrs = True).assign_attrs(attrs), spread_paths[i][0], None, complevel, chunksizes, pack_int16)
+
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        list(executor.map(write, range(len(times))))
+    for output in outputs:
+        output.close()
+
+    if store_timeseries:
+        from tools.timeseries import append_to_store
+        for name, name_paths in list(paths.items()) + [(name_ensemble, mean_paths)]:
+            with xr.open_mfdataset([lamta_path for nrt_path, lamta_path in name_paths], concat_dim='time', combine='nested') as written:
+                append_to_store('./maps_'+name+'/full_timeseries.zarr', written)
 
 
 import sys
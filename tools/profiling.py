@@ -0,0 +1,147 @@
+import os
+import csv
+import json
+import time
+import threading
+import cProfile
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+class RunProfiler:
+
+    """
+    Records wall time, CPU time, peak memory and I/O of the stages of an NRT-BFN run.
+
+    Args:
+        cprofile (bool): Also run cProfile on every stage and dump the statistics (.prof files, readable with pstats,
+            snakeviz or converted for flame graphs). Default is False.
+        sample_interval (float): Period of the memory sampling, in seconds. Default is 0.1.
+
+    Wall time is measured around the stage and CPU time on the thread running it. Peak RSS and bytes read/written
+    are those of the whole process over the duration of the stage: when stages overlap in a pipeline, they share
+    those figures. Memory and I/O require psutil; without it, the peak RSS of the process since its start is reported
+    and I/O is left empty. With cprofile, stages measured from several threads are run one at a time: a single profiler
+    can be active in a process (enforced from Python 3.12), so the profiled run is slower than a normal one.
+
+    Example:
+        profiler = RunProfiler()
+        with profiler.stage('compute_filled_map'):
+            compute_filled_map(BC_data_path, save_new_BC_to, bbox)
+        profiler.write_report('./maps_'+name_experiment+'/'+today.strftime('%Y%m%d')+'_report')
+    """
+
+    def __init__(self, cprofile = False, sample_interval = 0.1):
+        self.cprofile = cprofile
+        self.sample_interval = sample_interval
+        self.records = []
+        self.profiles = {}
+        self.active = {}
+        self.lock = threading.Lock()
+        self.cprofile_lock = threading.Lock()
+        self.sampler = None
+        self.process = psutil.Process() if psutil is not None else None
+
+    def sample(self):
+        while True:
+            with self.lock:
+                if not self.active:
+                    self.sampler = None
+                    return
+                rss = self.process.memory_info().rss
+                for record in self.active.values():
+                    record['peak_rss_MB'] = max(record['peak_rss_MB'], rss/1e6)
+            time.sleep(self.sample_interval)
+
+    def io_counters(self):
+        if self.process is None:
+            return None
+        try:
+            io = self.process.io_counters()
+        except (AttributeError, psutil.Error):
+            return None
+        return io.read_bytes, io.write_bytes
+
+    @contextmanager
+    def stage(self, name):
+
+        """
+        Context manager measuring the code run inside it as the stage 'name'.
+        """
+
+        # Wait for the stage being profiled in another thread, if any (not counted in the measures)
+        if self.cprofile:
+            self.cprofile_lock.acquire()
+
+        record = dict(stage = name, start = time.time(), wall_s = None, cpu_s = None, peak_rss_MB = 0., read_MB = None, written_MB = None)
+        io_start = self.io_counters()
+        cpu_start = time.thread_time()
+        wall_start = time.perf_counter()
+
+        with self.lock:
+            self.active[id(record)] = record
+            if self.process is not None and self.sampler is None:
+                self.sampler = threading.Thread(target = self.sample, daemon = True)
+                self.sampler.start()
+
+        profile = cProfile.Profile() if self.cprofile else None
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.profiles[name] = profile
+                self.cprofile_lock.release()
+
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.thread_time() - cpu_start
+            io_end = self.io_counters()
+            if io_start is not None and io_end is not None:
+                record['read_MB'] = (io_end[0]-io_start[0])/1e6
+                record['written_MB'] = (io_end[1]-io_start[1])/1e6
+
+            with self.lock:
+                del self.active[id(record)]
+                if self.process is not None:
+                    record['peak_rss_MB'] = max(record['peak_rss_MB'], self.process.memory_info().rss/1e6)
+                else:
+                    import resource
+                    record['peak_rss_MB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+                self.records.append(record)
+
+    def write_report(self, path):
+
+        """
+        Writes the run report.
+
+        Args:
+            path (str): Path of the report without extension. '<path>.json' and '<path>.csv' are written, and with cProfile
+                enabled, one '<path>_profiles/<stage>.prof' file per stage.
+
+        Returns:
+            list: The records, one dict per stage.
+        """
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        records = sorted(self.records, key = lambda record: record['start'])
+
+        with open(path+'.json', 'w') as f:
+            json.dump(records, f, indent = 1)
+
+        with open(path+'.csv', 'w', newline = '') as f:
+            writer = csv.DictWriter(f, fieldnames = list(records[0].keys()) if records else ['stage'])
+            writer.writeheader()
+            writer.writerows(records)
+
+        if self.profiles:
+            os.makedirs(path+'_profiles', exist_ok = True)
+            for name, profile in self.profiles.items():
+                profile.dump_stats(os.path.join(path+'_profiles', name+'.prof'))
+
+        print('Run report written to '+path+'.json')
+        return records
@@ -0,0 +1,156 @@
+import numpy as np
+import scipy.fft
+import scipy.sparse
+import scipy.sparse.linalg
+
+def spectral_operator(h, axis, order = 1, shift = 0.):
+    """ Derivative of a given order (0, 1 or 2) along an axis, in grid index units, evaluated at index + shift, by FFT
+
+    Args:
+        h (array): Field, of any shape (at least 4 points along the axis).
+        axis (int): Axis of the operator.
+        order (int, optional): Order of the derivative, 0 for an interpolation only. Default is 1.
+        shift (float, optional): The result is evaluated at index + shift, e.g. -0.5 for the middle of two points. Default is 0.
+
+    Returns:
+        array: The result, with the shape of h.
+
+    Regional grids are not periodic. Along each line, a cubic matching the values and (one-sided) second derivatives of
+    the field at both ends is removed, and the remainder, which vanishes at the ends with its second derivative, is
+    extended by odd symmetry: the extension is periodic and smooth up to the second derivative, which avoids Gibbs
+    oscillations. The cubic is differentiated exactly and added back.
+    """
+
+    h = np.moveaxis(np.asarray(h, dtype = np.float64), axis, -1)
+    n = h.shape[-1]
+    L = n-1
+
+    # Cubic p with p = h and p'' = h'' at both ends
+    c0 = 2*h[...,:1]-5*h[...,1:2]+4*h[...,2:3]-h[...,3:4]
+    cL = 2*h[...,-1:]-5*h[...,-2:-1]+4*h[...,-3:-2]-h[...,-4:-3]
+    a = (h[...,-1:]-h[...,:1])/L - c0*L/2 - (cL-c0)*L/6
+    x = np.arange(n, dtype = np.float64)
+    residual = h - (h[...,:1] + a*x + c0*x**2/2 + (cL-c0)*x**3/(6*L))
+
+    # Odd extension of the residual, of period 2L
+    extended = np.concatenate([residual, -residual[...,-2:0:-1]], axis = -1)
+    k = 2*np.pi*scipy.fft.rfftfreq(2*L)
+    multiplier = (1j*k)**order*np.exp(1j*k*shift)
+    if order % 2 or shift:
+        multiplier[-1] = 0 # Nyquist mode of an odd operator is not real
+    result = scipy.fft.irfft(scipy.fft.rfft(extended, axis = -1, workers = -1)*multiplier, n = 2*L, axis = -1, workers = -1)[...,:n]
+
+    xs = x + shift
+    if order == 0:
+        result += h[...,:1] + a*xs + c0*xs**2/2 + (cL-c0)*xs**3/(6*L)
+    elif order == 1:
+        result += a + c0*xs + (cL-c0)*xs**2/(2*L)
+    elif order == 2:
+        result += c0 + (cL-c0)*xs/L
+    else:
+        raise ValueError('Only derivatives of order 0, 1 and 2 are available')
+    return np.moveaxis(result, -1, axis)
+
+def spectral_uvrv(h, metrics, out = None):
+    """ SSH to U, V and normalized relative vorticity with spectral derivatives
+
+    Args:
+        h (array): SSH field of shape (..., lat, lon), e.g. (time, lat, lon), on a regular grid.
+        metrics (tools.grid.GridMetrics): Metrics of the grid.
+        out (tuple, optional): Preallocated (u, v, xi_norm) arrays with the shape of h.
+
+    Returns:
+        u (array): Zonal velocity
+        v (array): Meridional velocity
+        xi_norm (array): Normalized relative vorticity field
+
+    Raises:
+        ValueError: If h has undefined (NaN) points, e.g. land.
+
+    Same fields as tools.vars.h2uvrv, with exact derivatives of the Fourier interpolant instead of centred differences:
+    u and v are also evaluated half a grid step west and south of the points, like the finite difference stencils, and
+    the same Neumann conditions are applied at the edges, so that both engines give interchangeable products on fields
+    defined everywhere. Undefined points would spread to whole rows and columns through the transforms, and filling them
+    (e.g. with poisson_fill) leaves a kink at the edge of the mask, whose Gibbs oscillations make the derivatives far less
+    accurate than centred differences over tens of points: masked (coastal) domains must use the finite differences.
+    """
+
+    h = np.asarray(h, dtype = np.float64)
+    if np.isnan(h).any():
+        raise ValueError('Spectral derivatives need an SSH defined everywhere, use finite differences on masked domains')
+    dy, dx, g, f = metrics.dy, metrics.dx, metrics.g, metrics.f
+    if out is None:
+        out = tuple(np.zeros(h.shape) for _ in range(3))
+    u, v, xi_norm = out
+
+    u[...] = - g/f*spectral_operator(spectral_operator(h, -1, 0, -0.5), -2, 1)/dy
+    v[...] = + g/f*spectral_operator(spectral_operator(h, -2, 0, -0.5), -1, 1)/dx
+    xi_norm[...] = g/f**2*(spectral_operator(h, -2, 2)/dy**2 + spectral_operator(h, -1, 2)/dx**2)
+
+    # Condition de Neumann ( du/dn = 0 ), as in tools.vars
+    u[...,:,0] = u[...,:,1]
+    u[...,0,:] = u[...,1,:]
+    u[...,-1,:] = u[...,-2,:]
+
+    v[...,0,:] = v[...,1,:]
+    v[...,:,0] = v[...,:,1]
+    v[...,:,-1] = v[...,:,-2]
+
+    xi_norm[...,:,0] = xi_norm[...,:,1]
+    xi_norm[...,:,-1] = xi_norm[...,:,-2]
+    xi_norm[...,0,:] = xi_norm[...,1,:]
+    xi_norm[...,-1,:] = xi_norm[...,-2,:]
+
+    return u, v, xi_norm
+
+def poisson_fill(adt):
+    """ Fills the undefined (NaN) values of a single map with a direct sparse solver
+
+    Args:
+        adt (numpy.ndarray): The map, with dimensions (latitude, longitude).
+
+    Returns:
+        numpy.ndarray: The filled map, with dimensions (latitude, longitude).
+
+    Solves in one step the problem that processing.relax_fill and pyinterp.fill.gauss_seidel iterate on: Laplace equation
+    over the undefined points, with the defined points as boundary conditions and Neumann conditions at the edges of the
+    domain. The cost grows like that of a sparse factorization instead of a number of relaxation sweeps that grows with
+    the size of the gaps.
+    """
+
+    mask = np.isnan(adt)
+    filled = np.array(adt, dtype = float)
+    if not mask.any():
+        return filled
+    if mask.all():
+        filled[...] = 0.
+        return filled
+
+    ny, nx = adt.shape
+    unknown = -np.ones(adt.shape, dtype = int)
+    unknown[mask] = np.arange(mask.sum())
+    j, i = np.nonzero(mask)
+
+    rows, cols, values = [], [], []
+    diagonal = np.zeros(len(j))
+    rhs = np.zeros(len(j))
+    for dj, di in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        jn, in_ = j+dj, i+di
+        # Neighbours outside the domain equal the point itself (Neumann condition) and drop out of its equation
+        inside = (jn >= 0) & (jn < ny) & (in_ >= 0) & (in_ < nx)
+        jn, in_, p = jn[inside], in_[inside], np.flatnonzero(inside)
+        diagonal[p] -= 1
+        neighbour = unknown[jn, in_]
+        free = neighbour >= 0
+        rows.append(p[free])
+        cols.append(neighbour[free])
+        values.append(np.ones(free.sum()))
+        rhs[p[~free]] -= filled[jn[~free], in_[~free]]
+
+    rows.append(np.arange(len(j)))
+    cols.append(np.arange(len(j)))
+    values.append(diagonal)
+    A = scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape = (len(j), len(j)))
+
+    filled[mask] = scipy.sparse.linalg.spsolve(A, rhs)
+    return filled
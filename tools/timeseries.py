@@ -0,0 +1,89 @@
+import os
+import shutil
+import numpy as np
+import xarray as xr
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+def append_to_store(store, ds):
+
+    """
+    Adds time steps to a consolidated Zarr time series store, creating it if needed.
+
+    Args:
+        store (str): Path of the Zarr store (e.g. './maps_'+name_experiment+'/full_timeseries.zarr').
+        ds (xarray.Dataset): Time steps to add, along 'time', with the same variables and grid as the store.
+
+    Returns:
+        None
+
+    Time steps already in the store are overwritten in place (region writes), so that reprocessing a date is idempotent,
+    and later ones are appended, one Zarr chunk per time step. Metadata are consolidated, so that opening the store only
+    reads a single metadata object whatever its length. Time steps falling before the end of the store but not in it
+    (backfilling a gap) require the store to be rewritten.
+    """
+
+    if zarr is None:
+        raise ImportError('The time series store requires zarr (pip install zarr)')
+
+    # Chunking, compression and int16 packing of the NetCDF files the maps come from are not kept: packing parameters
+    # differ from file to file
+    ds = ds.sortby('time').chunk({'time': 1})
+    for name, var in ds.variables.items():
+        for key in ['chunks', 'preferred_chunks', 'chunksizes', 'zlib', 'complevel', 'shuffle']:
+            var.encoding.pop(key, None)
+        if name in ds.data_vars:
+            for key in ['dtype', 'scale_factor', 'add_offset', '_FillValue', 'missing_value']:
+                var.encoding.pop(key, None)
+
+    if not os.path.isdir(store):
+        ds.to_zarr(store, mode = 'w', consolidated = True)
+        return
+
+    with xr.open_zarr(store, consolidated = True) as existing:
+        times = existing.time.values
+        index = {t: i for i, t in enumerate(times)}
+
+        present = np.array([t in index for t in ds.time.values], dtype = bool)
+        new = ds.isel(time = np.flatnonzero(~present))
+
+        if new.sizes['time'] and new.time.values[0] <= times[-1]:
+            # Backfilling: rewrite the whole store, in time order
+            print('Rewriting '+store+' to insert dates before its end')
+            merged = xr.concat([existing.isel(time = np.flatnonzero(~np.isin(times, ds.time.values))), ds], dim = 'time').sortby('time')
+            merged.chunk({'time': 1}).to_zarr(store+'.tmp', mode = 'w', consolidated = True)
+            shutil.rmtree(store)
+            os.replace(store+'.tmp', store)
+            return
+
+    # Overwrite the dates already stored
+    fixed = [name for name, var in ds.variables.items() if 'time' not in var.dims]
+    for i in np.flatnonzero(present):
+        position = index[ds.time.values[i]]
+        ds.isel(time = [i]).drop_vars(fixed).to_zarr(store, region = {'time': slice(position, position+1)})
+
+    # Append the new ones
+    if new.sizes['time']:
+        new.to_zarr(store, append_dim = 'time', consolidated = True)
+
+def open_timeseries(store, start = None, end = None):
+
+    """
+    Opens (lazily) a window of a time series store written by append_to_store.
+
+    Args:
+        store (str): Path of the Zarr store.
+        start (datetime-like, optional): First date of the window. Default is None (start of the store).
+        end (datetime-like, optional): Last date of the window (included). Default is None (end of the store).
+
+    Returns:
+        xarray.Dataset: The time steps of the window, as dask arrays.
+    """
+
+    if zarr is None:
+        raise ImportError('The time series store requires zarr (pip install zarr)')
+
+    return xr.open_zarr(store, consolidated = True).sel(time = slice(start, end))
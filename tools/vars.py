@@ -1,109 +1,357 @@
 import numpy as np
 
-def h2uv(ssh,dy,dx,g,f, ubc=None,vbc=None):
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
+def field_values(ssh):
+    """ Array of an SSH field given as a DataArray (its data), a numpy or a dask array """
+
+    return ssh.data if hasattr(ssh, 'dims') else ssh
+
+def working_dtype(h, dtype = None):
+    """ Floating point type of the fields computed from h: dtype if given, else that of h (float64 for integer input) """
+
+    return np.dtype(dtype) if dtype is not None else np.result_type(h.dtype, np.float32)
+
+def apply_stencil(kernel, h, nout, out = None, dtype = None):
+    """ Applies a kernel(h, *out) writing nout fields of the shape of h, on a numpy array or on every block of a dask array
+
+    Blocks of a dask array are made to span the whole (lat, lon) grid, and only split along the leading dimensions.
+    """
+
+    if da is not None and isinstance(h, da.Array):
+        if out is not None:
+            raise ValueError('out is not supported for dask arrays')
+        dtype = working_dtype(h, dtype)
+        h = h.rechunk({h.ndim-2: -1, h.ndim-1: -1})
+        block = lambda b: np.stack(kernel(b, *(np.zeros(b.shape, dtype = dtype) for _ in range(nout))))
+        stacked = h.map_blocks(block, new_axis = 0, chunks = ((nout,),)+h.chunks, dtype = dtype)
+        fields = tuple(stacked[i] for i in range(nout))
+    else:
+        h = np.asarray(h)
+        if out is None:
+            out = tuple(np.zeros(h.shape, dtype = working_dtype(h, dtype)) for _ in range(nout))
+        elif nout == 1 and not isinstance(out, tuple):
+            out = (out,)
+        fields = kernel(h, *out)
+    return fields if nout > 1 else fields[0]
+
+def h2uv_numpy(h, dy, dx, g, f, u, v):
+    """ U and V over any leading (time, member, ...) dimensions, see h2uv """
+
+    u[...,1:-1,1:] = - g/f[1:-1,1:]*(h[...,2:,:-1]+h[...,2:,1:]-h[...,:-2,1:]-h[...,:-2,:-1])/(4*dy[1:-1,1:])
+    v[...,1:,1:-1] = + g/f[1:,1:-1]*(h[...,1:,2:]+h[...,:-1,2:]-h[...,:-1,:-2]-h[...,1:,:-2])/(4*dx[1:,1:-1])
+
+    # Condition de Neumann ( du/dn = 0 )
+    u[...,:,0] = u[...,:,1]
+    u[...,0,:] = u[...,1,:]
+    u[...,-1,:] = u[...,-2,:]
+    
+    v[...,0,:] = v[...,1,:]
+    v[...,:,0] = v[...,:,1]
+    v[...,:,-1] = v[...,:,-2]
+
+    return u,v
+
+def h2rv_numpy(h, dy, dx, g, f, xi_norm):
+    """ Normalized relative vorticity over any leading (time, member, ...) dimensions, see h2rv """
+
+    # Normalized relative vorticity
+    xi_norm[...,1:-1,1:-1] = (1/f[1:-1,1:-1]) * g/f[1:-1,1:-1]*\
+        ((h[...,2:,1:-1]+h[...,:-2,1:-1]-2*h[...,1:-1,1:-1])/dy[1:-1,1:-1]**2 + (h[...,1:-1,2:]+h[...,1:-1,:-2]-2*h[...,1:-1,1:-1])/dx[1:-1,1:-1]**2)
+
+    # Condition de Neumann ( dq/dn = 0 )
+    xi_norm[...,:,0] = xi_norm[...,:,1]
+    xi_norm[...,:,-1] = xi_norm[...,:,-2]
+    xi_norm[...,0,:] = xi_norm[...,1,:]
+    xi_norm[...,-1,:] = xi_norm[...,-2,:]
+
+    return (xi_norm,)
+
+def h2pv_numpy(h, dy, dx, g, f, c, q):
+    """ Potential vorticity over any leading (time, member, ...) dimensions, see h2pv """
+
+    # Potential vorticity
+    q[...,1:-1,1:-1] = g/f[1:-1,1:-1]*\
+        ((h[...,2:,1:-1]+h[...,:-2,1:-1]-2*h[...,1:-1,1:-1])/dy[1:-1,1:-1]**2 +\
+            (h[...,1:-1,2:]+h[...,1:-1,:-2]-2*h[...,1:-1,1:-1])/dx[1:-1,1:-1]**2) -\
+            g*f[1:-1,1:-1]/(c[1:-1,1:-1]**2) *h[...,1:-1,1:-1]
+
+    # Condition de Neumann ( dq/dn = 0 )
+    q[...,:,0] = q[...,:,1]
+    q[...,:,-1] = q[...,:,-2]
+    q[...,0,:] = q[...,1,:]
+    q[...,-1,:] = q[...,-2,:]
+
+    return (q,)
+
+def select_backend(backend, h):
+    """ Backend of the operators: 'numba', 'numpy' or 'auto' (numba when installed, except for dask arrays whose blocks are already computed in parallel) """
+
+    if backend == 'auto':
+        return 'numba' if numba is not None and not (da is not None and isinstance(h, da.Array)) else 'numpy'
+    if backend == 'numba' and numba is None:
+        raise ImportError('numba is not installed')
+    return backend
+
+def numba_stencil(kernel, h, params, out):
+    """ Runs a compiled kernel on h seen as a (batch, lat, lon) array, writing into the arrays of out """
+
+    shape = h.shape
+    h3 = np.ascontiguousarray(h).reshape((-1,)+shape[-2:])
+    out3 = [o.reshape(h3.shape) if o.flags.c_contiguous else np.empty(h3.shape, dtype = o.dtype) for o in out]
+    kernel(h3, *params, *out3)
+    for o, o3 in zip(out, out3):
+        if not np.shares_memory(o, o3):
+            o[...] = o3.reshape(shape)
+    return tuple(out)
+
+if numba is not None:
+
+    # Compiled versions of the numpy stencils, parallel over the rows of all the maps of the batch. Every point is
+    # computed in one pass, boundary points directly from the interior point the Neumann condition copies them from.
+
+    @numba.njit(parallel = True, cache = True)
+    def h2uv_numba(h, dy, dx, g, f, u, v):
+        nb, ny, nx = h.shape
+        for k in numba.prange(nb*ny):
+            b = k // ny
+            j = k % ny
+            ju = min(max(j, 1), ny-2)
+            jv = max(j, 1)
+            for i in range(nx):
+                iu = max(i, 1)
+                iv = min(max(i, 1), nx-2)
+                u[b,j,i] = - g/f[ju,iu]*(h[b,ju+1,iu-1]+h[b,ju+1,iu]-h[b,ju-1,iu]-h[b,ju-1,iu-1])/(4*dy[ju,iu])
+                v[b,j,i] = + g/f[jv,iv]*(h[b,jv,iv+1]+h[b,jv-1,iv+1]-h[b,jv-1,iv-1]-h[b,jv,iv-1])/(4*dx[jv,iv])
+
+    @numba.njit(parallel = True, cache = True)
+    def h2rv_numba(h, dy, dx, g, f, xi_norm):
+        nb, ny, nx = h.shape
+        for k in numba.prange(nb*ny):
+            b = k // ny
+            jj = min(max(k % ny, 1), ny-2)
+            for i in range(nx):
+                ii = min(max(i, 1), nx-2)
+                xi_norm[b,k % ny,i] = (1/f[jj,ii]) * g/f[jj,ii]*\
+                    ((h[b,jj+1,ii]+h[b,jj-1,ii]-2*h[b,jj,ii])/dy[jj,ii]**2 + (h[b,jj,ii+1]+h[b,jj,ii-1]-2*h[b,jj,ii])/dx[jj,ii]**2)
+
+    @numba.njit(parallel = True, cache = True)
+    def h2pv_numba(h, dy, dx, g, f, c, q):
+        nb, ny, nx = h.shape
+        for k in numba.prange(nb*ny):
+            b = k // ny
+            jj = min(max(k % ny, 1), ny-2)
+            for i in range(nx):
+                ii = min(max(i, 1), nx-2)
+                q[b,k % ny,i] = g/f[jj,ii]*\
+                    ((h[b,jj+1,ii]+h[b,jj-1,ii]-2*h[b,jj,ii])/dy[jj,ii]**2 +\
+                        (h[b,jj,ii+1]+h[b,jj,ii-1]-2*h[b,jj,ii])/dx[jj,ii]**2) -\
+                        g*f[jj,ii]/(c[jj,ii]**2) *h[b,jj,ii]
+
+def h2uv(ssh,dy=None,dx=None,g=None,f=None, ubc=None,vbc=None, metrics=None, out=None, backend='auto', dtype=None):
     """ SSH to U,V
 
     Args:
-        ssh (2D array): SSH field.
+        ssh (array): SSH field, as a 2D (lat, lon) DataArray, or a numpy or dask array of shape (..., lat, lon), e.g. (time, lat, lon).
         dy (2D array): Height of grid points
         dx (2D array): Width of grid points
         f (2D array): Coriolis parameter
         g (scalar): Acceleration of gravity (m.s-2)
+        metrics (tools.grid.GridMetrics, optional): Metrics of the grid, used instead of dy, dx, g and f.
+        out (tuple, optional): Preallocated (u, v) arrays with the shape of ssh (numpy only).
+        backend (str, optional): 'numba' (compiled, parallel over rows), 'numpy' or 'auto' (numba if installed). Default is 'auto'.
+        dtype (numpy.dtype, optional): Type of the results, e.g. np.float32. Default is None (that of ssh).
 
     Returns:
-        u (2D array): Zonal velocity  
-        v (2D array): Meridional velocity
+        u (array): Zonal velocity, with the shape of ssh
+        v (array): Meridional velocity, with the shape of ssh
     """
 
-    h = ssh.values
+    if metrics is not None:
+        dy, dx, g, f = metrics.dy, metrics.dx, metrics.g, metrics.f
 
-    ny = len(ssh.lat)
-    nx = len(ssh.lon)
+    h = field_values(ssh)
+    if select_backend(backend, h) == 'numba':
+        kernel = lambda h, u, v: numba_stencil(h2uv_numba, h, (dy, dx, g, f), (u, v))
+    else:
+        kernel = lambda h, u, v: h2uv_numpy(h, dy, dx, g, f, u, v)
+    return apply_stencil(kernel, h, 2, out, dtype)
 
-    u = np.zeros((ny,nx))
-    v = np.zeros((ny,nx))
 
-    u[1:-1,1:] = - g/f[1:-1,1:]*(h[2:,:-1]+h[2:,1:]-h[:-2,1:]-h[:-2,:-1])/(4*dy[1:-1,1:])
-    v[1:,1:-1] = + g/f[1:,1:-1]*(h[1:,2:]+h[:-1,2:]-h[:-1,:-2]-h[1:,:-2])/(4*dx[1:,1:-1])
+def h2rv(ssh,dy=None,dx=None,g=None,f=None, metrics=None, out=None, backend='auto', dtype=None):
+    """ SSH to Q
 
-    # Condition de Neumann ( du/dn = 0 )
-    u[:,0] = u[:,1]
-    u[0,:] = u[1,:]
-    u[-1,:] = u[-2,:]
-    
-    v[0,:] = v[1,:]
-    v[:,0] = v[:,1]
-    v[:,-1] = v[:,-2]
-    
-    return u,v
+    Args:
+        ssh (array): SSH field, as a 2D (lat, lon) DataArray, or a numpy or dask array of shape (..., lat, lon), e.g. (time, lat, lon).
+        dy (2D array): Height of grid points
+        dx (2D array): Width of grid points
+        f (2D array): Coriolis parameter
+        g (scalar): Acceleration of gravity (m.s-2)
+        metrics (tools.grid.GridMetrics, optional): Metrics of the grid, used instead of dy, dx, g and f.
+        out (array, optional): Preallocated array with the shape of ssh (numpy only).
+        backend (str, optional): 'numba' (compiled, parallel over rows), 'numpy' or 'auto' (numba if installed). Default is 'auto'.
+        dtype (numpy.dtype, optional): Type of the results, e.g. np.float32. Default is None (that of ssh).
+
+    Returns:
+        xi_norm: Normalized relative vorticity field, with the shape of ssh
+    """
+
+    if metrics is not None:
+        dy, dx, g, f = metrics.dy, metrics.dx, metrics.g, metrics.f
 
+    h = field_values(ssh)
+    if select_backend(backend, h) == 'numba':
+        kernel = lambda h, xi_norm: numba_stencil(h2rv_numba, h, (dy, dx, g, f), (xi_norm,))
+    else:
+        kernel = lambda h, xi_norm: h2rv_numpy(h, dy, dx, g, f, xi_norm)
+    return apply_stencil(kernel, h, 1, out, dtype)
 
-def h2rv(ssh,dy,dx,g,f):
+
+def h2pv(ssh,dy=None,dx=None,g=None,f=None, c=None, metrics=None, out=None, backend='auto', dtype=None):
     """ SSH to Q
 
     Args:
-        h (2D array): SSH field.
+        ssh (array): SSH field, as a 2D (lat, lon) DataArray, or a numpy or dask array of shape (..., lat, lon), e.g. (time, lat, lon).
+        c (2D array): Phase speed of first baroclinic radius 
         dy (2D array): Height of grid points
         dx (2D array): Width of grid points
         f (2D array): Coriolis parameter
         g (scalar): Acceleration of gravity (m.s-2)
+        metrics (tools.grid.GridMetrics, optional): Metrics of the grid, used instead of dy, dx, g and f.
+        out (array, optional): Preallocated array with the shape of ssh (numpy only).
+        backend (str, optional): 'numba' (compiled, parallel over rows), 'numpy' or 'auto' (numba if installed). Default is 'auto'.
+        dtype (numpy.dtype, optional): Type of the results, e.g. np.float32. Default is None (that of ssh).
 
     Returns:
-        xi_norm: Normalized relative vorticity field  
+        q: Potential Vorticity field, with the shape of ssh
     """
-        
-    h = ssh.values
 
-    ny = len(ssh.lat)
-    nx = len(ssh.lon)
+    if metrics is not None:
+        dy, dx, g, f = metrics.dy, metrics.dx, metrics.g, metrics.f
 
-    xi_norm = np.zeros((ny,nx))
+    h = field_values(ssh)
+    if select_backend(backend, h) == 'numba':
+        kernel = lambda h, q: numba_stencil(h2pv_numba, h, (dy, dx, g, f, c), (q,))
+    else:
+        kernel = lambda h, q: h2pv_numpy(h, dy, dx, g, f, c, q)
+    return apply_stencil(kernel, h, 1, out, dtype)
 
-    # Normalized relative vorticity
-    xi_norm[1:-1,1:-1] = (1/f[1:-1,1:-1]) * g/f[1:-1,1:-1]*\
-        ((h[2:,1:-1]+h[:-2,1:-1]-2*h[1:-1,1:-1])/dy[1:-1,1:-1]**2 + (h[1:-1,2:]+h[1:-1,:-2]-2*h[1:-1,1:-1])/dx[1:-1,1:-1]**2)
+def geostrophic_coefficients(dy, dx, g, f):
+    """ Stencil coefficients of the geostrophic operators, computed once per grid
 
-    # Condition de Neumann ( dq/dn = 0 )
-    xi_norm[:,0] = xi_norm[:,1]
-    xi_norm[:,-1] = xi_norm[:,-2]
-    xi_norm[0,:] = xi_norm[1,:]
-    xi_norm[-1,:] = xi_norm[-2,:]
+    Args:
+        dy (2D array): Height of grid points
+        dx (2D array): Width of grid points
+        g (scalar): Acceleration of gravity (m.s-2)
+        f (2D array): Coriolis parameter
 
-    return xi_norm
+    Returns:
+        dict: cu = -g/(4 f dy), cv = g/(4 f dx), cxi = g/f², idy2 = 1/dy², idx2 = 1/dx² (2D arrays)
+    """
 
+    return dict(cu = -g/(4*f*dy), cv = g/(4*f*dx), cxi = g/f**2, idy2 = 1/dy**2, idx2 = 1/dx**2)
 
-def h2pv(ssh,dy,dx,g,f, c=None):
-    """ SSH to Q
+def h2uvrv_numpy(h, cu, cv, cxi, idy2, idx2, u, v, xi_norm):
+    """ Vectorized U, V and normalized relative vorticity over any leading (time, ...) dimensions, see h2uvrv """
+
+    u[...,1:-1,1:] = cu[1:-1,1:]*(h[...,2:,:-1]+h[...,2:,1:]-h[...,:-2,1:]-h[...,:-2,:-1])
+    v[...,1:,1:-1] = cv[1:,1:-1]*(h[...,1:,2:]+h[...,:-1,2:]-h[...,:-1,:-2]-h[...,1:,:-2])
+    xi_norm[...,1:-1,1:-1] = cxi[1:-1,1:-1]*\
+        ((h[...,2:,1:-1]+h[...,:-2,1:-1]-2*h[...,1:-1,1:-1])*idy2[1:-1,1:-1] + (h[...,1:-1,2:]+h[...,1:-1,:-2]-2*h[...,1:-1,1:-1])*idx2[1:-1,1:-1])
+
+    # Condition de Neumann ( du/dn = 0 )
+    u[...,:,0] = u[...,:,1]
+    u[...,0,:] = u[...,1,:]
+    u[...,-1,:] = u[...,-2,:]
+
+    v[...,0,:] = v[...,1,:]
+    v[...,:,0] = v[...,:,1]
+    v[...,:,-1] = v[...,:,-2]
+
+    xi_norm[...,:,0] = xi_norm[...,:,1]
+    xi_norm[...,:,-1] = xi_norm[...,:,-2]
+    xi_norm[...,0,:] = xi_norm[...,1,:]
+    xi_norm[...,-1,:] = xi_norm[...,-2,:]
+
+if numba is not None:
+
+    @numba.njit(parallel = True, cache = True)
+    def h2uvrv_numba(h, cu, cv, cxi, idy2, idx2, u, v, xi_norm):
+        """ Same as h2uvrv_numpy for (time, lat, lon) arrays, one time step per thread, without temporary arrays """
+
+        nt, ny, nx = h.shape
+        for t in numba.prange(nt):
+            for j in range(1, ny):
+                for i in range(1, nx):
+                    if j < ny-1:
+                        u[t,j,i] = cu[j,i]*(h[t,j+1,i-1]+h[t,j+1,i]-h[t,j-1,i]-h[t,j-1,i-1])
+                    if i < nx-1:
+                        v[t,j,i] = cv[j,i]*(h[t,j,i+1]+h[t,j-1,i+1]-h[t,j-1,i-1]-h[t,j,i-1])
+                    if j < ny-1 and i < nx-1:
+                        xi_norm[t,j,i] = cxi[j,i]*((h[t,j+1,i]+h[t,j-1,i]-2*h[t,j,i])*idy2[j,i] + (h[t,j,i+1]+h[t,j,i-1]-2*h[t,j,i])*idx2[j,i])
+
+            # Condition de Neumann ( du/dn = 0 )
+            for j in range(ny):
+                u[t,j,0] = u[t,j,1]
+            for i in range(nx):
+                u[t,0,i] = u[t,1,i]
+                u[t,ny-1,i] = u[t,ny-2,i]
+                v[t,0,i] = v[t,1,i]
+            for j in range(ny):
+                v[t,j,0] = v[t,j,1]
+                v[t,j,nx-1] = v[t,j,nx-2]
+                xi_norm[t,j,0] = xi_norm[t,j,1]
+                xi_norm[t,j,nx-1] = xi_norm[t,j,nx-2]
+            for i in range(nx):
+                xi_norm[t,0,i] = xi_norm[t,1,i]
+                xi_norm[t,ny-1,i] = xi_norm[t,ny-2,i]
+
+def h2uvrv(h, dy = None, dx = None, g = None, f = None, out = None, coefs = None, backend = 'auto', metrics = None, dtype = None):
+    """ SSH to U, V and normalized relative vorticity in a single pass
 
     Args:
-        h (2D array): SSH field.
-        c (2D array): Phase speed of first baroclinic radius 
+        h (3D array): SSH field (time, lat, lon), or any array whose last two dimensions are (lat, lon).
         dy (2D array): Height of grid points
         dx (2D array): Width of grid points
-        f (2D array): Coriolis parameter
         g (scalar): Acceleration of gravity (m.s-2)
+        f (2D array): Coriolis parameter
+        out (tuple, optional): Preallocated (u, v, xi_norm) arrays with the shape of h.
+        coefs (dict, optional): Output of geostrophic_coefficients, to avoid recomputing it for every call.
+        backend (str, optional): 'numba' (compiled, parallel over time), 'numpy' or 'auto' (numba if installed). Default is 'auto'.
+        metrics (tools.grid.GridMetrics, optional): Metrics of the grid, used instead of dy, dx, g, f and coefs.
+        dtype (numpy.dtype, optional): Type of the results when out is not given, e.g. np.float32. Default is None (that of h).
 
     Returns:
-        q: Potential Vorticity field  
-    """
-        
-    h = ssh.values
+        u (array): Zonal velocity
+        v (array): Meridional velocity
+        xi_norm (array): Normalized relative vorticity field
 
-    ny = len(ssh.lat)
-    nx = len(ssh.lon)
+    Same results as h2uv and h2rv applied to every time step, but the whole cube is processed at once and the
+    coefficients g/f, 1/dx² and 1/dy² are only computed once.
+    """
 
-    q = np.zeros((ny,nx))
+    h = np.asarray(h)
+    if metrics is not None:
+        coefs = metrics.coefs
+    if coefs is None:
+        coefs = geostrophic_coefficients(dy, dx, g, f)
+    if out is None:
+        out = tuple(np.zeros(h.shape, dtype = working_dtype(h, dtype)) for _ in range(3))
+    u, v, xi_norm = out
 
-    # Potential vorticity
-    q[1:-1,1:-1] = g/f[1:-1,1:-1]*\
-        ((h[2:,1:-1]+h[:-2,1:-1]-2*h[1:-1,1:-1])/dy[1:-1,1:-1]**2 +\
-            (h[1:-1,2:]+h[1:-1,:-2]-2*h[1:-1,1:-1])/dx[1:-1,1:-1]**2) -\
-            g*f[1:-1,1:-1]/(c[1:-1,1:-1]**2) *h[1:-1,1:-1]
-
-    # Condition de Neumann ( dq/dn = 0 )
-    q[:,0] = q[:,1]
-    q[:,-1] = q[:,-2]
-    q[0,:] = q[1,:]
-    q[-1,:] = q[-2,:]
+    if backend == 'numba' or (backend == 'auto' and numba is not None and h.ndim == 3):
+        if numba is None:
+            raise ImportError('numba is not installed')
+        h2uvrv_numba(h, coefs['cu'], coefs['cv'], coefs['cxi'], coefs['idy2'], coefs['idx2'], u, v, xi_norm)
+    else:
+        h2uvrv_numpy(h, coefs['cu'], coefs['cv'], coefs['cxi'], coefs['idy2'], coefs['idx2'], u, v, xi_norm)
 
-    return q
\ No newline at end of file
+    return u, v, xi_norm